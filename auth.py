@@ -0,0 +1,84 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+## roles which may take attendance without the verification code
+LEADER_ROLES = ('Leader',)
+
+## Telegram IDs allowed to use the maintenance commands, e.g. ADMIN_TELEGRAM_IDS=1234,5678
+ADMIN_IDS = {telegram_id.strip() for telegram_id in os.getenv('ADMIN_TELEGRAM_IDS', '').split(',') if telegram_id.strip()}
+
+
+class AuthCache:
+    """Telegram ID -> person lookups through the person table's telegram_id index, cached with a TTL.
+
+    Results are also kept in the user's own conversation state (user_data['_auth']), which
+    the bot persists, so a restarted poller or a fresh Lambda container skips the lookup too."""
+
+    def __init__(self, db, ttl=None, negative_ttl=300):
+        self.db = db
+        self.ttl = float(ttl or os.getenv('AUTH_TTL', 24 * 3600))
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = {}   # telegram_id -> (person or None, expires)
+
+    def lookup(self, telegram_id):
+        """The person registered with this Telegram ID, or None."""
+        telegram_id = str(telegram_id)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(telegram_id)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        try:
+            person = self.db.get_person_by_telegram_id(telegram_id)
+        except Exception:
+            # e.g. the telegram_id index is not built yet; treat the user as unknown for now
+            logger.exception("could not look up telegram_id %s", telegram_id)
+            return None
+        with self.lock:
+            self.entries[telegram_id] = (person, now + (self.ttl if person else self.negative_ttl))
+        return person
+
+    def forget(self, telegram_id):
+        with self.lock:
+            self.entries.pop(str(telegram_id), None)
+
+    def resolve(self, telegram_id, user_data):
+        """The auth record of a user: {'person': Person or None, 'verified': bool, 'code': bool, 'expires': ts}.
+
+        A user is verified once they typed the verification code ('code'), or while they are
+        registered in one of the LEADER_ROLES; other registered members still need the code.
+        The record persisted in user_data is used while it is fresh, else it is rebuilt from the cache."""
+        record = user_data.get('_auth')
+        ## records persisted before people were Person models, or before 'code' was kept, are rebuilt
+        if record is not None and record['expires'] > time.time() and not isinstance(record['person'], dict) and 'code' in record:
+            return record
+
+        person = self.lookup(telegram_id)
+        code = bool(record and record.get('code'))
+        record = {
+            'person': person,
+            'verified': code or (person is not None and person.role in LEADER_ROLES),
+            'code': code,
+            'expires': time.time() + (self.ttl if person else self.negative_ttl),
+        }
+        user_data['_auth'] = record
+        return record
+
+    def verified(self, telegram_id, user_data):
+        """Remember that this user has typed the verification code."""
+        record = self.resolve(telegram_id, user_data)
+        record['verified'] = record['code'] = True
+
+    @staticmethod
+    def is_leader(record):
+        return record['person'] is not None and record['person'].role in LEADER_ROLES
+
+    @staticmethod
+    def is_admin(telegram_id):
+        return str(telegram_id) in ADMIN_IDS
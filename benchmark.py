@@ -0,0 +1,141 @@
+"""Benchmarks against a local DynamoDB, e.g. one started with
+
+    docker run -p 8000:8000 amazon/dynamodb-local
+    python benchmark.py client-pool --endpoint-url http://localhost:8000
+
+The models benchmark runs without a database.
+"""
+import argparse
+import itertools
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+
+from dynamodbhelperv4 import DynamoDBHelper, get_client
+from models import AttendanceRecord, Person
+from roster import RosterCache
+
+
+def seed(db, cell_group='ONE', event_type='Sunday Service', date_attended=datetime(2024, 7, 7), members=40):
+    """Create the tables if needed and record one session of `members` attendees."""
+    db.setup()
+    for i in range(members):
+        db.add_attendance(cell_group, event_type, date_attended, f'Member {i:03d}', 'Present')
+    return cell_group, event_type, date_attended
+
+def run_concurrently(handlers, calls, work):
+    """Run `work(handler)` `calls` times on each of `handlers` threads and return calls per second."""
+    def handler(n):
+        for _ in range(calls):
+            work(n)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=handlers) as pool:
+        list(pool.map(handler, range(handlers)))
+    return handlers * calls / (time.perf_counter() - start)
+
+
+################################### client pool ###################################
+def bench_client_pool(endpoint_url, handlers=32, calls=50):
+    """Session reads from concurrent handlers: a default client per handler vs the shared tuned client."""
+    session = seed(DynamoDBHelper(get_client(endpoint_url=endpoint_url)))
+
+    default_helpers = [DynamoDBHelper(boto3.client('dynamodb', endpoint_url=endpoint_url)) for _ in range(handlers)]
+    default_rate = run_concurrently(handlers, calls, lambda n: default_helpers[n].get_session_attendance(*session))
+
+    shared = DynamoDBHelper(get_client(endpoint_url=endpoint_url, max_pool_connections=handlers))
+    shared_rate = run_concurrently(handlers, calls, lambda n: shared.get_session_attendance(*session))
+
+    print(f"{handlers} handlers x {calls} session reads")
+    print(f"  default client per handler : {default_rate:8.1f} reads/s")
+    print(f"  shared tuned client        : {shared_rate:8.1f} reads/s")
+
+
+################################### write sharding ###################################
+def bench_write_sharding(endpoint_url, handlers=32, calls=50, shards=8):
+    """A Sunday-morning burst: every handler writes rows for the same date, unsharded vs sharded.
+
+    DynamoDB Local does not throttle hot partitions, so locally this mostly shows the cost of
+    sharding (scatter-gather reads); against DynamoDB the unsharded burst is the one throttled."""
+    client = get_client(endpoint_url=endpoint_url, max_pool_connections=handlers)
+    results = {}
+    for label, shard_count, date_attended in [('unsharded', 1, datetime(2024, 7, 14)), (f'{shards} shards', shards, datetime(2024, 7, 21))]:
+        db = DynamoDBHelper(client, shards=shard_count)
+        db.setup()
+        counter = itertools.count()
+        write_rate = run_concurrently(handlers, calls, lambda n: db.add_attendance(
+            f'Cell {n}', 'Sunday Service', date_attended, f'Member {next(counter):05d}', 'Present'
+        ))
+        read_rate = run_concurrently(handlers, 5, lambda n: db.get_session_attendance(f'Cell {n}', 'Sunday Service', date_attended))
+        results[label] = (write_rate, read_rate)
+
+    print(f"{handlers} handlers x {calls} writes to one date")
+    for label, (write_rate, read_rate) in results.items():
+        print(f"  {label:<12}: {write_rate:8.1f} writes/s, {read_rate:8.1f} session reads/s")
+
+
+################################### models ###################################
+def allocated(build):
+    """Bytes still allocated by what build() returns."""
+    tracemalloc.start()
+    kept = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size
+
+def bench_models(endpoint_url=None, handlers=32, calls=50, members=60, rows=5000):
+    """Dict rows vs slotted models: memory of a cell's history. Category lists vs the selection dict: CPU of one keyboard tap.
+    Runs locally; endpoint_url and handlers are not used."""
+    items = [{'cell_group': 'ONE', 'event_type': 'Sunday Service', 'date_attended': f'2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}',
+              'name': f'Member {i % members:03d}', 'attendance_type': 'Present', 'cell_month': 'ONE#2024-01', 'month_bucket': '2024-01'} for i in range(rows)]
+    dict_bytes = allocated(lambda: [dict(item) for item in items])
+    model_bytes = allocated(lambda: [AttendanceRecord.from_item(item) for item in items])
+
+    ## a tap checks the tapped name against its list category, adds it and rebuilds the keyboard: the
+    ## cell's members less everyone selected. Both sides go through roster.unselected(); one list per
+    ## category (as sessions were kept) is unioned into a set on every tap, while the {name: attendance_type}
+    ## selection conversation.py keeps is looked up in place and its keys are already that set
+    people = [{'name': f'Member {i:03d}', 'role': 'Member', 'cell_group': 'ONE', 'telegram_id': 'None'} for i in range(members)]
+    roster = RosterCache()
+    roster.load_people([Person.from_item(person) for person in people])
+    lists = [[f'Member {i:03d}' for i in range(0, members, 3)], [f'Member {i:03d}' for i in range(1, members, 7)]]
+    selection = {name: attendance_type for names, attendance_type in zip(lists, ['Present', 'Absent Valid']) for name in names}
+    tapped = lists[0][-1]
+    taps = calls * 200
+
+    start = time.perf_counter()
+    for _ in range(taps):
+        tapped not in lists[0]
+        roster.unselected('ONE', set().union(*lists))
+    lists_tap = (time.perf_counter() - start) / taps
+
+    start = time.perf_counter()
+    for _ in range(taps):
+        selection.get(tapped) != 'Present'
+        roster.unselected('ONE', selection.keys())
+    selection_tap = (time.perf_counter() - start) / taps
+
+    print(f"{rows} history rows, a cell of {members}")
+    print(f"  dict rows       : {dict_bytes / rows:6.0f} bytes/row")
+    print(f"  models          : {model_bytes / rows:6.0f} bytes/row")
+    print(f"  category lists  : {lists_tap * 1e6:6.1f} us/tap")
+    print(f"  selection dict  : {selection_tap * 1e6:6.1f} us/tap")
+
+
+BENCHMARKS = {
+    'client-pool': bench_client_pool,
+    'write-sharding': bench_write_sharding,
+    'models': bench_models,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--endpoint-url', default='http://localhost:8000')
+    parser.add_argument('--handlers', type=int, default=32)
+    parser.add_argument('--calls', type=int, default=50)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args.endpoint_url, handlers=args.handlers, calls=args.calls)
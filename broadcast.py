@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """`rate` tokens per second, at most `capacity` saved up. take() waits for a token."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Hand out nothing for `seconds`, e.g. after Telegram answers with RetryAfter."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def take(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Broadcaster:
+    """Sends many messages without tripping Telegram's flood limits or blocking the handlers.
+
+    Messages are queued and sent by `workers` concurrent tasks. Every send takes a token from
+    the global bucket (BROADCAST_RATE messages per second, 25 by default, under Telegram's ~30)
+    and from its chat's bucket (one message per second). RetryAfter pauses the global bucket
+    for as long as Telegram asks and retries; network errors are retried with backoff up to
+    max_attempts; chats which blocked the bot or no longer exist are counted as failed."""
+
+    def __init__(self, rate=None, per_chat_rate=1.0, workers=8, max_attempts=5):
+        self.rate = float(rate or os.getenv('BROADCAST_RATE', 25))
+        self.per_chat_rate = per_chat_rate
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.loop = None
+        self.bucket = None
+        self.chat_buckets = {}
+        self.tasks = set()
+
+    def start(self, application, messages, progress=None):
+        """Send [(chat_id, text)] in the background and return the task; progress(sent, failed, total)
+        is awaited every 25 messages and once at the end."""
+        task = application.create_task(self.send(application.bot, messages, progress))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def join(self):
+        """Wait for every background broadcast, e.g. before a Lambda invocation returns."""
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def send(self, bot, messages, progress=None):
+        """Send [(chat_id, text)] and return (sent, failed)."""
+        ## the buckets belong to the running event loop, which a Lambda invocation replaces
+        if self.loop is not asyncio.get_running_loop():
+            self.loop, self.bucket, self.chat_buckets = asyncio.get_running_loop(), TokenBucket(self.rate), {}
+        queue = asyncio.Queue()
+        for message in messages:
+            queue.put_nowait(message)
+        total, counts = queue.qsize(), {'sent': 0, 'failed': 0}
+
+        async def report():
+            if progress is not None:
+                try:
+                    await progress(counts['sent'], counts['failed'], total)
+                except Exception:
+                    logger.exception("broadcast progress report failed")
+
+        async def worker():
+            while not queue.empty():
+                chat_id, text = queue.get_nowait()
+                counts['sent' if await self.deliver(bot, chat_id, text) else 'failed'] += 1
+                if (counts['sent'] + counts['failed']) % 25 == 0:
+                    await report()
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, total))))
+        if total % 25 or not total:
+            await report()
+        logger.info("broadcast finished: %s sent, %s failed", counts['sent'], counts['failed'])
+        return counts['sent'], counts['failed']
+
+    async def deliver(self, bot, chat_id, text):
+        """Send one message under both rate limits. Returns whether it was delivered."""
+        chat_bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.per_chat_rate, 1))
+        delay = 1.0
+        for attempt in range(self.max_attempts):
+            await chat_bucket.take()
+            await self.bucket.take()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                return True
+            except RetryAfter as e:
+                logger.warning("flood limit reached, pausing broadcasts for %s s", e.retry_after)
+                self.bucket.pause(float(e.retry_after))
+            except (Forbidden, BadRequest) as e:
+                logger.info("could not message chat %s: %s", chat_id, e)
+                return False
+            except NetworkError:
+                await asyncio.sleep(delay)
+                delay *= 2
+        logger.warning("gave up messaging chat %s after %s attempts", chat_id, self.max_attempts)
+        return False
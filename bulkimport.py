@@ -0,0 +1,73 @@
+import csv
+import io
+import zipfile
+
+## header names recognised for the two columns of an upload
+NAME_HEADERS = ('name', 'full name', 'member')
+TYPE_HEADERS = ('attendance', 'attendance type', 'attendance_type', 'status', 'type')
+
+## how many unmatched rows are kept for the summary; the rest are only counted
+MAX_REPORTED = 30
+
+
+def iter_rows(fileobj, filename):
+    """Yield the rows of a CSV or XLSX upload one at a time, as lists of strings.
+
+    CSV is decoded as it is read; XLSX is opened in openpyxl's read-only mode, which
+    streams rows from the sheet instead of loading the workbook into memory."""
+    if filename.lower().endswith('.xlsx'):
+        try:
+            import openpyxl
+        except ImportError:
+            raise ValueError("XLSX uploads need openpyxl installed, please send a CSV instead")
+        try:
+            workbook = openpyxl.load_workbook(fileobj, read_only=True, data_only=True)
+        except zipfile.BadZipFile:
+            raise ValueError("this is not a valid XLSX file")
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield ['' if value is None else str(value) for value in row]
+        finally:
+            workbook.close()
+    else:
+        for row in csv.reader(io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')):
+            yield row
+
+
+def parse_attendance(rows, match_name, attendance_types, default_type):
+    """Match uploaded rows against the roster.
+
+    match_name(text) returns the roster spelling of a name or None, and attendance_types maps
+    lower-cased words ('present', 'valid absentees', ...) to attendance types. Returns
+    ({attendance_type: set of names}, number of unmatched rows, first MAX_REPORTED unmatched rows as (line, name, reason))."""
+    matched, unmatched, reported = {}, 0, []
+    name_column, type_column = 0, None
+
+    for line, row in enumerate(rows, start=1):
+        cells = [cell.strip() for cell in row]
+        if not any(cells):
+            continue
+
+        ## a header row names the columns, otherwise the first column holds the names
+        if line == 1:
+            headers = [cell.lower() for cell in cells]
+            if any(header in NAME_HEADERS for header in headers):
+                name_column = next(i for i, header in enumerate(headers) if header in NAME_HEADERS)
+                type_column = next((i for i, header in enumerate(headers) if header in TYPE_HEADERS), None)
+                continue
+
+        text = cells[name_column] if name_column < len(cells) else ''
+        name = match_name(text) if text else None
+        attendance_type = default_type
+        if type_column is not None and type_column < len(cells) and cells[type_column]:
+            attendance_type = attendance_types.get(cells[type_column].lower())
+
+        if name is None or attendance_type is None:
+            unmatched += 1
+            if len(reported) < MAX_REPORTED:
+                reason = 'not on the roster' if name is None else f"unknown attendance '{cells[type_column]}'"
+                reported.append((line, text or '(blank name)', reason))
+            continue
+        matched.setdefault(attendance_type, set()).add(name)
+
+    return matched, unmatched, reported
@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import queue
+
+from boto3.dynamodb.types import TypeDeserializer
+
+from dynamodbhelperv4 import get_client
+
+logger = logging.getLogger(__name__)
+deserializer = TypeDeserializer()
+
+
+def parse_record(record, table=None):
+    """Turn one DynamoDB Streams record into (table, event_name, new_image, old_image).
+
+    The images are plain dicts of python values. The table name comes from the
+    source that read it, a 'table' field, or the record's eventSourceARN (Lambda triggers)."""
+    table = table or record.get('table')
+    if table is None:
+        table = record['eventSourceARN'].split(':table/')[1].split('/')[0]
+    images = record['dynamodb']
+    new_image = {key: deserializer.deserialize(value) for key, value in images.get('NewImage', {}).items()}
+    old_image = {key: deserializer.deserialize(value) for key, value in images.get('OldImage', {}).items()}
+    return table, record['eventName'], new_image, old_image
+
+
+################################### Sources ###################################
+class DynamoDBStreamSource:
+    """Reads new records from the stream of one DynamoDB table, shard by shard.
+
+    Shards open at start-up are read from LATEST; shards which appear later are children of
+    those, so they are read from TRIM_HORIZON. Shard iterators expire after 15 minutes (e.g.
+    in a frozen Lambda container); an expired one is fetched again after the last record
+    read from its shard."""
+
+    def __init__(self, table, client=None, streams_client=None):
+        self.table = table
+        self.client = client or get_client()
+        self.streams = streams_client or get_client('dynamodbstreams')
+        self.stream_arn = self.client.describe_table(TableName=table)['Table']['LatestStreamArn']
+        self.iterators = {}   # shard id -> next iterator, None once the shard is closed
+        self.positions = {}   # shard id -> sequence number of the last record read
+        self.started = False
+
+    def _iterator(self, shard_id, iterator_type):
+        kwargs = {'SequenceNumber': self.positions[shard_id]} if iterator_type == 'AFTER_SEQUENCE_NUMBER' else {}
+        return self.streams.get_shard_iterator(
+            StreamArn=self.stream_arn, ShardId=shard_id, ShardIteratorType=iterator_type, **kwargs
+        )['ShardIterator']
+
+    def _refresh_shards(self):
+        iterator_type = 'TRIM_HORIZON' if self.started else 'LATEST'
+        for shard in self.streams.describe_stream(StreamArn=self.stream_arn)['StreamDescription']['Shards']:
+            if shard['ShardId'] not in self.iterators:
+                self.iterators[shard['ShardId']] = self._iterator(shard['ShardId'], iterator_type)
+        self.started = True
+
+    def _get_records(self, shard_id, iterator):
+        try:
+            return self.streams.get_records(ShardIterator=iterator)
+        except self.streams.exceptions.ExpiredIteratorException:
+            iterator_type = 'AFTER_SEQUENCE_NUMBER' if shard_id in self.positions else 'TRIM_HORIZON'
+            logger.info("shard iterator of %s expired, reading it again from %s", shard_id, iterator_type)
+            return self.streams.get_records(ShardIterator=self._iterator(shard_id, iterator_type))
+
+    def read(self):
+        self._refresh_shards()
+        for shard_id, iterator in list(self.iterators.items()):
+            if iterator is None:
+                continue
+            response = self._get_records(shard_id, iterator)
+            # a closed shard has no next iterator; keep it as None so it is not reopened
+            self.iterators[shard_id] = response.get('NextShardIterator')
+            for record in response['Records']:
+                self.positions[shard_id] = record['dynamodb']['SequenceNumber']
+                yield parse_record(record, self.table)
+
+
+class FileStreamSource:
+    """Local stand-in for a stream: a JSON-lines file of stream records, read from where it left off."""
+
+    def __init__(self, path, table=None):
+        self.path = path
+        self.table = table
+        self.offset = 0
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                f.seek(self.offset)
+                for line in iter(f.readline, ''):
+                    if not line.endswith('\n'):
+                        break  # half-written line, pick it up next time
+                    self.offset = f.tell()
+                    if line.strip():
+                        yield parse_record(json.loads(line), self.table)
+        except FileNotFoundError:
+            return
+
+
+class QueueStreamSource:
+    """Local stand-in for a stream: stream records put on an in-process queue."""
+
+    def __init__(self, table=None):
+        self.table = table
+        self.queue = queue.Queue()
+
+    def put(self, record):
+        self.queue.put(record)
+
+    def read(self):
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            yield parse_record(record, self.table)
+
+
+################################### Consumer ###################################
+class ChangeFeed:
+    """Pushes the records of every source into a RosterCache, then hands each to the listeners."""
+
+    def __init__(self, cache, sources, listeners=()):
+        self.cache = cache
+        self.sources = sources
+        self.listeners = list(listeners)
+
+    @property
+    def live(self):
+        """Whether person changes reach the cache through this feed at all."""
+        return any(source.table in (None, 'person') for source in self.sources)
+
+    def apply(self, change):
+        self.cache.apply(change)
+        for listener in self.listeners:
+            listener(change)
+
+    def poll(self):
+        """Apply every record that arrived since the last poll and return how many there were."""
+        applied = 0
+        for source in self.sources:
+            try:
+                for change in source.read():
+                    self.apply(change)
+                    applied += 1
+            except Exception:
+                logger.exception("could not read change records from %s", source)
+        return applied
+
+    def handle_event(self, event):
+        """Apply the records of a DynamoDB Streams Lambda trigger event."""
+        for record in event.get('Records', []):
+            self.apply(parse_record(record))
+
+
+def make_change_feed(cache, db, listeners=()):
+    """Build the change feed for the running bot.
+
+    CHANGE_FEED_FILE points to a local JSON-lines stand-in, otherwise the streams of the
+    person table, the attendance table and (with compact sessions) attendance_session are
+    read; tables need StreamSpecification enabled, see DynamoDBHelper.enable_streams().
+    Attendance records only reach the listeners, which drop the cached exports and member
+    summaries they outdate. No aggregates are kept from them: those would only count changes
+    since start-up unless the whole table were scanned first, and nothing needs them, as
+    exports and /myattendance read history through the date indexes instead.
+    Local SQLite storage has no streams: the bot is its only writer, and the roster
+    version counter catches the rest."""
+    path = os.getenv('CHANGE_FEED_FILE')
+    if path:
+        return ChangeFeed(cache, [FileStreamSource(path)], listeners)
+    if not hasattr(db, 'client'):
+        return ChangeFeed(cache, [], listeners)
+    sources = []
+    for table in ['person', 'attendance'] + (['attendance_session'] if db.compact else []):
+        try:
+            sources.append(DynamoDBStreamSource(table, db.client))
+        except Exception:
+            logger.warning("no stream on table %s, its changes will not be pushed", table)
+    return ChangeFeed(cache, sources, listeners)
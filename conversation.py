@@ -0,0 +1,1149 @@
+import asyncio
+import functools
+import html
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+from datetime import datetime
+from typing import Dict
+
+from botocore.exceptions import BotoCoreError, ClientError
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram.ext import (
+    CallbackQueryHandler,
+    CommandHandler,
+    ContextTypes,
+    ConversationHandler,
+    MessageHandler,
+    TypeHandler,
+    filters,
+)
+
+from auth import LEADER_ROLES, AuthCache
+from broadcast import Broadcaster
+from bulkimport import iter_rows, parse_attendance
+from changefeed import make_change_feed
+from dynamodbhelperv4 import CircuitOpenError, encode_date
+from export import EXPORT_FORMATS, ReportExporter
+from memberhistory import MemberHistory
+from models import AttendanceSession, Person
+from outbox import Outbox, transient
+from profiling import UpdateProfiler
+from roster import RosterCache
+from sessions import DraftStore, SessionTracker
+from snapshot import RosterLoader
+from sqlitestore import make_storage
+## DynamoDB, or a local SQLite file with STORAGE_BACKEND=sqlite, see sqlitestore.py
+db = make_storage()
+
+## what a read raises when DynamoDB is throttled, timing out or behind an open circuit breaker,
+## or the SQLite file is locked; handlers then carry on in the degraded mode described at begin_categories().
+## The tuple also matches errors which are bugs (a missing table or index, AccessDenied), so every handler
+## re-raises what transient() does not call an outage, and those reach the error log instead
+UNAVAILABLE = (CircuitOpenError, BotoCoreError, ClientError, sqlite3.OperationalError)
+
+## every write goes through the local outbox first, see outbox.py; once written, the
+## caches it outdates are dropped by written()
+outbox = Outbox(db, on_written=lambda ops: written(ops))
+
+## returning users are recognised by their Telegram ID, see auth.py
+auth = AuthCache(db)
+
+## slow updates are profiled when PROFILE_DIR is set, see profiling.py
+profiler = UpdateProfiler()
+
+## the roster is loaded once (from the /tmp snapshot when it is still current) and then
+## kept fresh by the change feed and by cheap checks of the roster version counter
+roster = RosterCache()
+feed = make_change_feed(roster, db, listeners=[lambda change: changed(change)])
+roster_loader = RosterLoader(roster, db, feed=feed)
+
+logger = logging.getLogger(__name__)
+
+
+################################### Conversation Spec ###################################
+## The whole conversation is described by the data below. main.py and lambda_function.py
+## only build the ConversationHandler from it with build_conversation_handler().
+
+EVENT_TYPES = ['Sunday Service', 'Cell Group', 'Others']
+MONTHS = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
+DAYS = [str(day) for day in range(1, 32)]
+
+## words on the keyboard which are not member names
+CONTROL_WORDS = ['DONE', 'REMOVE', 'NONE']
+
+## the selection steps, in order. 'key' is where the reply is stored in user_data,
+## 'options' is what a valid reply looks like, and 'prompt'/'keyboard' ask the next question.
+LOGIN_REPLY, CHOOSING_CELL, CHOOSING_EVENTTYPE, CHOOSING_MONTH, CHOOSING_DAY = range(5)
+SELECTION_STEPS = [
+    {
+        'state': LOGIN_REPLY, 'key': None, 'options': None,
+        'prompt': "Welcome {first_name}! What cell group are we taking attendance for?",
+        'keyboard': 'cells',
+    },
+    {
+        'state': CHOOSING_CELL, 'key': 'Cell', 'options': 'cells',
+        'prompt': "You have selected {Cell}! What type of event is this for?",
+        'keyboard': [[event_type] for event_type in EVENT_TYPES],
+    },
+    {
+        'state': CHOOSING_EVENTTYPE, 'key': 'Event Type', 'options': EVENT_TYPES,
+        'prompt': "You are taking {Cell}'s attendance for {Event Type}! What month are we taking attendance for?",
+        'keyboard': [MONTHS[i:i+3] for i in range(0, len(MONTHS), 3)],
+    },
+    {
+        'state': CHOOSING_MONTH, 'key': 'month', 'options': MONTHS,
+        'prompt': "You are taking {Cell}'s attendance for {Event Type}, in the month of {month}! What day are we taking attendance for?",
+        'keyboard': [DAYS[i:i+3] for i in range(0, len(DAYS), 3)],
+    },
+    {
+        'state': CHOOSING_DAY, 'key': 'day', 'options': DAYS,
+        'prompt': None,  # the last step hands over to the first list category
+        'keyboard': None,
+    },
+]
+
+## the attendance lists that are filled in after the date is chosen, in order. Each category
+## gets its own choosing/removing states generated from this spec, and all categories are
+## loaded and committed together, so adding one here costs no extra round-trips. A new session
+## of a 'prefill' category starts from the names of the previous session, see prefill().
+LIST_CATEGORIES = [
+    {
+        'key': 'Attendees', 'attendance_type': 'Present', 'label': 'attendees', 'new_members': True, 'prefill': True,
+        'prompt': "Neat! Let's begin with our attendees. Who was present?",
+        'more': "Got it! Any more attendees?",
+        'hint': " If there are new friends, type in their name! Preferably their first and last name, e.g. Nehemiah Tan."
+                " For big events, you can also send a CSV or Excel file with a 'name' column (and optionally an 'attendance' column).",
+    },
+    {
+        'key': 'Valid Absentees', 'attendance_type': 'Absent Valid', 'label': 'valid absentees', 'new_members': False, 'prefill': False,
+        'prompt': "Great, let's move to our valid absentees. Who was absent with valid reasons?",
+        'more': "Got it! Any more valid absentees?",
+        'hint': "",
+    },
+]
+for n, category in enumerate(LIST_CATEGORIES):
+    category['choosing_state'] = len(SELECTION_STEPS) + 2 * n
+    category['removing_state'] = len(SELECTION_STEPS) + 2 * n + 1
+
+## a backfill (/backfill) takes the dates as one typed list after the event type, then goes
+## through the list categories once per date with every session prefetched in one batched read
+BACKFILL_DATES = len(SELECTION_STEPS) + 2 * len(LIST_CATEGORIES)
+
+## monthly sheets for /export, cached until the cell's month is written to again, see export.py
+exporter = ReportExporter(db, event_types=EVENT_TYPES)
+
+## members' own summaries for /myattendance, cached until they are written to, see memberhistory.py
+member_history = MemberHistory(db, event_types=EVENT_TYPES)
+
+## messages to members go through the rate-limited broadcaster, see broadcast.py. Each is off
+## unless its text is set, e.g. FOLLOWUP_MESSAGE="Hi {name}, we missed you at {event_type} on {date}!"
+broadcaster = Broadcaster()
+FOLLOWUP_MESSAGE = os.getenv('FOLLOWUP_MESSAGE')
+REMINDER_MESSAGE = os.getenv('REMINDER_MESSAGE')
+
+## sessions idle for SESSION_TIMEOUT_SECONDS, or the least recently used beyond MAX_TRACKED_SESSIONS,
+## are put aside as drafts which /resume picks up again, see sessions.py and park()
+drafts = DraftStore()
+sessions = SessionTracker(on_evict=lambda user_id, user_data: park(user_id, user_data))
+
+
+################################### Helper Function ###################################
+def facts_to_str(user_data: Dict[str, str]) -> str:
+    """Helper function for formatting the gathered user info."""
+    ## the list categories are shown once the session has reached them
+    selected = selection(user_data) if 'Date' in user_data else None
+    facts = [f"{key}: {value}\n" for key, value in user_data.items() if not key.startswith('_')]
+
+    if selected is not None:
+        for n, category in enumerate(LIST_CATEGORIES):
+            names = category_names(user_data, category)
+            prefix = '' if n == 0 else '\n'
+            facts.append(f"{prefix}{category['key']} ({len(names)}):")
+            for m, item in enumerate(names):
+                facts.append(f'{m+1}. {item}')
+
+    return "\n".join(facts).join(["\n", "\n"])
+
+def clean_date(user_data: Dict[str, str]) -> datetime:
+    """Helper function for turning the stored attendance date into a datetime."""
+    return datetime.strptime(user_data['Date'], '%Y-%b-%d')
+
+def attendance_year(month: str, day: str) -> int:
+    """Helper function for the year of the most recent {month} {day} which is not in the future,
+    so January sessions entered for last December land in last year."""
+    today = datetime.now()
+    try:
+        if datetime.strptime(f'{today.year}-{month}-{day}', '%Y-%b-%d') > today:
+            return today.year - 1
+    except ValueError:
+        pass  # e.g. 29 Feb outside a leap year, which clean_date() rejects later
+    return today.year
+
+def selection(user_data: Dict[str, str]) -> Dict[str, str]:
+    """Helper function for the names placed in the list categories so far, as {name: attendance_type} in the
+    order they were picked. A tap looks up and updates it in place, and its keys are the set of everyone
+    selected, so nothing is rebuilt per tap. Sessions and drafts kept from before it had one list per
+    category key instead; those are moved into it here."""
+    if '_selected' not in user_data:
+        user_data['_selected'] = {name: category['attendance_type'] for category in LIST_CATEGORIES for name in user_data.pop(category['key'], [])}
+    return user_data['_selected']
+
+def select(user_data: Dict[str, str], name: str, attendance_type: str) -> None:
+    """Helper function for placing a name in a list category; a name already in another one moves."""
+    selected = selection(user_data)
+    selected.pop(name, None)
+    selected[name] = attendance_type
+
+def category_names(user_data: Dict[str, str], category: dict) -> list:
+    """Helper function for the names of one list category, in the order they were picked."""
+    return [name for name, attendance_type in selection(user_data).items() if attendance_type == category['attendance_type']]
+
+def session_of(user_data: Dict[str, str]) -> AttendanceSession:
+    """Helper function for the selection of a session as an AttendanceSession."""
+    by_type = {}
+    for name, attendance_type in selection(user_data).items():
+        by_type.setdefault(attendance_type, []).append(name)
+    return AttendanceSession.from_types(user_data['Cell'], user_data['Event Type'], encode_date(clean_date(user_data)), by_type)
+
+class CellGroupFilter(filters.MessageFilter):
+    """Matches the name of a cell group currently in the roster, so new cells need no restart."""
+    def filter(self, message):
+        return roster.has_cell(message.text)
+
+def clear_session(user_data: Dict[str, str]) -> None:
+    """Helper function for ending a session: drops everything but the persisted auth record."""
+    record = user_data.get('_auth')
+    user_data.clear()
+    if record is not None:
+        user_data['_auth'] = record
+
+def session_payload(user_data: Dict[str, str], by_name: Dict[str, str]) -> dict:
+    """Helper function for the outbox payload of a compact session write, from {name: attendance_type}."""
+    by_type = {}
+    for name, attendance_type in by_name.items():
+        by_type.setdefault(attendance_type, []).append(name)
+    ## a session taken without reading the stored one is merged into it rather than replacing it
+    return {'cell_group': user_data['Cell'], 'event_type': user_data['Event Type'], 'date_attended': encode_date(clean_date(user_data)), 'by_type': by_type, 'merge': '_degraded' in user_data}
+
+def saved_text(user_data: Dict[str, str], saved: str = "") -> str:
+    """Helper function for telling the user that their submission is queued while DynamoDB is unavailable."""
+    if '_degraded' in user_data or (db.breaker is not None and db.breaker.is_open):
+        saved = "Our database is busy right now, so your submission is queued and will be saved automatically."
+    return f"{saved} " if saved else ""
+
+def parse_backfill(text: str, event_type: str):
+    """Helper function for reading a backfill list such as '7 Jul, Cell Group 10 Jul, Jul 14'.
+    Returns the sessions as [(event type, 'YYYY-Mon-D')], without repeats, and the parts it could not read."""
+    sessions, bad = [], []
+    for part in re.split(r'[,\n]+', text):
+        part = part.strip()
+        if not part:
+            continue
+        session_event_type = event_type
+        for candidate in EVENT_TYPES:
+            if part.lower().startswith(candidate.lower()):
+                session_event_type, part = candidate, part[len(candidate):].strip()
+        words = [word[:3].title() for word in part.split()]
+        month = next((word for word in words if word in MONTHS), None)
+        day = next((word.lstrip('0') for word in words if word.isdigit()), None)
+        try:
+            if month is None or day is None or len(words) != 2:
+                raise ValueError(part)
+            date = f'{attendance_year(month, day)}-{month}-{day}'
+            datetime.strptime(date, '%Y-%b-%d')
+        except ValueError:
+            bad.append(part)
+            continue
+        if (session_event_type, date) not in sessions:
+            sessions.append((session_event_type, date))
+    return sessions, bad
+
+def load_session(user_data: Dict[str, str], recorded: AttendanceSession) -> None:
+    """Helper function for filling the list categories from what is already recorded for the session."""
+    user_data['_selected'] = dict(sorted(recorded.by_name().items()))
+    user_data['_recorded'] = recorded.by_name()
+
+def prefill(user_data: Dict[str, str], previous: AttendanceSession) -> bool:
+    """Helper function for starting an empty session from the previous one: the 'prefill' categories
+    get its names which are still in the cell. Returns whether anything was filled in."""
+    members = set(roster.cell_members(user_data['Cell']))
+    for category in LIST_CATEGORIES:
+        if category['prefill']:
+            for name in sorted(previous.names(category['attendance_type']) & members):
+                select(user_data, name, category['attendance_type'])
+    return bool(selection(user_data))
+
+async def prefill_reply(update: Update, previous: AttendanceSession) -> None:
+    """Tell the user which session the selection was copied from."""
+    await update.message.reply_text(
+        f"<i>To save you some taps, I have started from the {html.escape(previous.event_type)} on {previous.date_attended}. "
+        "Select 'REMOVE' for anyone who was not here this time, and add anyone new.</i>",
+        parse_mode = 'HTML'
+    )
+
+def absentee_messages(user_data: Dict[str, str]) -> list:
+    """Helper function for the follow-ups to cell members who are in no list category of the session.
+    Absentees of an earlier commit of the session were followed up at the time, so an edit only
+    messages members who were recorded before and are absent now."""
+    if not FOLLOWUP_MESSAGE:
+        return []
+    absent = roster.unselected(user_data['Cell'], selection(user_data).keys())
+    if user_data.get('_recorded'):
+        absent &= set(user_data['_recorded'])
+    return [
+        (telegram_id, FOLLOWUP_MESSAGE.format(name=name, cell=user_data['Cell'], event_type=user_data['Event Type'], date=user_data['Date']))
+        for name, telegram_id in sorted(roster.telegram_ids(absent).items())
+    ]
+
+def draft_of(user_data: Dict[str, str]):
+    """Helper function for the JSON draft of a session which has reached the list categories, or None."""
+    if 'Date' not in user_data:
+        return None
+    draft = {key: value for key, value in user_data.items() if key not in ('_auth', '_touched', '_recorded', '_suggestions', '_backfill')}
+    if '_backfill' in user_data:
+        ## what is recorded is read again on /resume, so only the entered sessions are kept
+        draft['_backfill'] = {key: user_data['_backfill'][key] for key in ('queue', 'ops', 'done')}
+    return draft
+
+def park(user_id, user_data: Dict[str, str]) -> bool:
+    """Helper function for evicting a session: keep it as a draft if it is worth resuming, then clear it."""
+    draft = draft_of(user_data)
+    if draft is not None:
+        drafts.save(user_id, draft)
+    clear_session(user_data)
+    return draft is not None
+
+def rows(names, last_row):
+    """Helper function for a one-name-per-row keyboard followed by the control buttons."""
+    return ReplyKeyboardMarkup(sorted([[name] for name in names]) + [last_row], one_time_keyboard=True)
+
+
+################################### State Function ###################################
+## /start
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Start the conversation, skipping verification for users we already know."""
+    user_data = context.user_data
+    user_data.pop('_backfill', None)
+    record = await asyncio.to_thread(auth.resolve, update.effective_user.id, user_data)
+
+    ## known leaders go straight to the event type with their own cell pre-selected
+    if auth.is_leader(record) and roster.has_cell(record['person'].cell_group):
+        user_data['Cell'] = record['person'].cell_group
+        await update.message.reply_text(
+            f"Welcome back {update.effective_user.first_name}! We are taking {user_data['Cell']}'s attendance."
+            " What type of event is this for?\n<i>To take another cell's attendance, type its name.</i>",
+            reply_markup=ReplyKeyboardMarkup(SELECTION_STEPS[CHOOSING_CELL]['keyboard'], one_time_keyboard=True),
+            parse_mode = 'HTML'
+        )
+        return CHOOSING_EVENTTYPE
+
+    ## users who verified before go straight to the cell selection
+    if record['verified']:
+        return await select_cell(update, context)
+
+    await update.message.reply_text(
+        f"Hi! This is an attendance bot for PoD, the youth ministry of COSB. If you wish to exit the attendance taking at any point of this exercise, simple type '/exit'."
+        "\n\n<b>Before we begin, I have to verify you. Please kindly insert the verification code.</b>",
+        parse_mode = 'HTML'
+    )
+
+    return LOGIN_REPLY
+
+
+## verification
+async def verified(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Remember that the user typed the verification code and ask for the cell group."""
+    await asyncio.to_thread(auth.verified, update.effective_user.id, context.user_data)
+    return await select_cell(update, context)
+
+
+def make_selection_handler(n: int):
+    """Build the handler which stores the reply to selection step n and asks the next question."""
+    step = SELECTION_STEPS[n]
+
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        if step['key'] is not None:
+            context.user_data[step['key']] = update.message.text
+
+        ## a backfill asks for all of its dates at once instead of a month and a day
+        if step['state'] == CHOOSING_EVENTTYPE and '_backfill' in context.user_data:
+            await update.message.reply_text(
+                f"You are backfilling {context.user_data['Cell']}'s {context.user_data['Event Type']} attendance! Which dates?"
+                "\n<i>Type them separated by commas, e.g. '7 Jul, 14 Jul, 21 Jul'. Put an event type before a date for another event, e.g. 'Cell Group 10 Jul'.</i>",
+                reply_markup=ReplyKeyboardRemove(),
+                parse_mode = 'HTML'
+            )
+            return BACKFILL_DATES
+
+        ## the last step hands over to the first list category
+        if step['prompt'] is None:
+            return await begin_categories(update, context)
+
+        keyboard = [[cell] for cell in roster.cell_groups()] if step['keyboard'] == 'cells' else step['keyboard']
+        await update.message.reply_text(
+            step['prompt'].format_map({**context.user_data, 'first_name': update.effective_user.first_name}),
+            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True),
+            parse_mode = 'HTML'
+        )
+        return SELECTION_STEPS[n + 1]['state']
+
+    return handler
+
+## the cell group question, asked after verification
+select_cell = make_selection_handler(LOGIN_REPLY)
+
+
+## selecting the date and loading the session
+async def begin_categories(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Store the attendance date, load what is already recorded and ask for the first list."""
+    user_data = context.user_data
+
+    ## store into the context object the user's date
+    user_data["Date"] = str(attendance_year(user_data["month"], user_data["day"])) + f'-{user_data["month"]}-{user_data["day"]}'
+    del user_data["month"]
+    del user_data["day"]
+
+    ## one query fetches every category already recorded for this session. When DynamoDB is
+    ## unavailable the session starts empty instead, and is merged into the stored one when written
+    try:
+        recorded = await asyncio.to_thread(db.get_session_attendance, user_data["Cell"], user_data["Event Type"], clean_date(user_data))
+    except UNAVAILABLE as e:
+        if not transient(e):
+            raise
+        logger.warning("could not read the session, continuing without it", exc_info=True)
+        recorded = AttendanceSession(user_data["Cell"], user_data["Event Type"], encode_date(clean_date(user_data)))
+        user_data['_degraded'] = True
+        await update.message.reply_text(
+            "<i>Our database is busy, so I can't show who is already recorded for this session. "
+            "Whatever you enter will be queued and added to it.</i>",
+            parse_mode = 'HTML'
+        )
+    load_session(user_data, recorded)
+
+    ## a session with nothing recorded yet starts from the previous one, which costs one bounded query
+    if not recorded.types and '_degraded' not in user_data:
+        try:
+            previous = await asyncio.to_thread(db.get_previous_session, user_data["Cell"], user_data["Event Type"], clean_date(user_data))
+        except UNAVAILABLE as e:
+            if not transient(e):
+                raise
+            logger.warning("could not read the previous session, starting empty", exc_info=True)
+            previous = None
+        if previous is not None and prefill(user_data, previous):
+            await prefill_reply(update, previous)
+
+    return await choose(0, update, context)
+
+
+## backfill
+async def backfill(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Start a backfill: the same questions as /start, then a list of dates instead of one."""
+    state = await start(update, context)
+    context.user_data['_backfill'] = {}
+    return state
+
+
+async def backfill_dates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Read the list of dates, prefetch every session in one batched read and open the first."""
+    user_data = context.user_data
+    sessions, bad = parse_backfill(update.message.text, user_data['Event Type'])
+    if bad or not sessions:
+        await update.message.reply_text(
+            f"Sorry, I could not read {', '.join(repr(part) for part in bad) or 'any dates'}. Please type the dates again, e.g. '7 Jul, 14 Jul'."
+        )
+        return BACKFILL_DATES
+    ## attendance is keyed by (date, name), so two sessions on one date would overwrite each other's rows
+    clashes = sorted({date for _, date in sessions if sum(other == date for _, other in sessions) > 1})
+    if clashes:
+        await update.message.reply_text(
+            f"Sorry, attendance can only be recorded for one event a day, and {', '.join(clashes)} "
+            "has more than one. Please type the dates again with one event per date."
+        )
+        return BACKFILL_DATES
+
+    try:
+        recorded = await asyncio.to_thread(
+            db.get_sessions_attendance, user_data['Cell'], [(event_type, datetime.strptime(date, '%Y-%b-%d')) for event_type, date in sessions]
+        )
+    except UNAVAILABLE as e:
+        if not transient(e):
+            raise
+        logger.warning("could not prefetch the backfill sessions, continuing without them", exc_info=True)
+        recorded = {(event_type, encode_date(date)): AttendanceSession(user_data['Cell'], event_type, encode_date(date)) for event_type, date in sessions}
+        user_data['_degraded'] = True
+        await update.message.reply_text(
+            "<i>Our database is busy, so I can't show who is already recorded for these sessions. "
+            "Whatever you enter will be queued and added to them.</i>",
+            parse_mode = 'HTML'
+        )
+    user_data['_backfill'] = {
+        'queue': sessions,
+        'recorded': {(event_type, date): recorded[(event_type, encode_date(date))] for event_type, date in sessions},
+        'ops': [],
+        'done': [],
+        'previous': {},   # event type -> the AttendanceSession last entered in this backfill
+    }
+    return await next_backfill_session(update, context)
+
+
+async def next_backfill_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Open the next session of the backfill from the prefetched attendance."""
+    user_data = context.user_data
+    backfill = user_data['_backfill']
+    event_type, date = backfill['queue'].pop(0)
+    user_data['Event Type'], user_data['Date'] = event_type, date
+    recorded = backfill['recorded'].pop((event_type, date))
+    load_session(user_data, recorded)
+
+    ## an empty session starts from the session of the same event type entered just before it
+    previous = backfill['previous'].get(event_type)
+    if not recorded.types and previous is not None and prefill(user_data, previous):
+        await prefill_reply(update, previous)
+    return await choose(0, update, context)
+
+
+async def choose(n: int, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Ask the user for the members of list category n."""
+    category = LIST_CATEGORIES[n]
+    user_data = context.user_data
+
+    ## prepare lists of the relevant cell members
+    relevant_cell_members = roster.unselected(user_data["Cell"], selection(user_data).keys())
+
+    ## reply
+    await update.message.reply_text(
+        f"<b>{category['prompt']}</b>\n"
+        f"{facts_to_str(user_data)}\n<i>Instructions: Select 'REMOVE' to remove {category['label']}. Select 'NONE' if no {category['label']} to add.{category['hint']}</i>",
+        reply_markup=rows(relevant_cell_members, ['REMOVE','NONE']),
+        parse_mode = 'HTML'
+    )
+
+    return category['choosing_state']
+
+
+def make_category_handlers(n: int):
+    """Build the handlers of list category n: received, picked, remove, remove_update and next."""
+    category = LIST_CATEGORIES[n]
+
+    ## Storing the information and asking for more cell members
+    async def received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        user_data = context.user_data
+        text = update.message.text
+        if text != 'DONE' and selection(user_data).get(text) != category['attendance_type']:
+            ## a typed name which is not on the roster is matched against it, so near-duplicates
+            ## like 'nehemiah tan ' resolve to the stored 'Nehemiah Tan' instead of a new person
+            if not roster.is_member(text):
+                match = roster.match_name(text)
+                if match is None:
+                    candidates = roster.suggest_names(text)
+                    if candidates:
+                        return await suggest(update.message, context, text, candidates)
+                text = match or text
+            select(user_data, text, category['attendance_type'])
+
+        return await more(update.message, context)
+
+    ## offering roster names close to what was typed
+    async def suggest(message, context: ContextTypes.DEFAULT_TYPE, text: str, candidates) -> int:
+        context.user_data['_suggestions'] = candidates + [text]
+        buttons = [[InlineKeyboardButton(candidate, callback_data=f'pick:{i}')] for i, candidate in enumerate(candidates)]
+        buttons.append([InlineKeyboardButton(f'No, add "{text}"', callback_data=f'pick:{len(candidates)}')])
+
+        await message.reply_text(
+            f"<b>Did you mean one of these?</b>\n<i>We already have members with names close to '{html.escape(text)}'.</i>",
+            reply_markup=InlineKeyboardMarkup(buttons),
+            parse_mode = 'HTML'
+        )
+
+        return category['choosing_state']
+
+    ## Storing the suggestion the user tapped
+    async def picked(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        user_data = context.user_data
+        query = update.callback_query
+        await query.answer()
+        await query.edit_message_reply_markup(None)
+
+        suggestions = user_data.pop('_suggestions', [])
+        choice = int(query.data.split(':')[1])
+        if choice < len(suggestions):
+            select(user_data, suggestions[choice], category['attendance_type'])
+
+        return await more(query.message, context)
+
+    ## asking for more cell members
+    async def more(message, context: ContextTypes.DEFAULT_TYPE) -> int:
+        user_data = context.user_data
+
+        ## prepare lists of the relevant cell members
+        relevant_cell_members = roster.unselected(user_data["Cell"], selection(user_data).keys())
+
+        ## reply
+        await message.reply_text(
+            f"<b>{category['more']}</b>\n"
+            f"{facts_to_str(user_data)}\n<i>Instructions: Select 'REMOVE' to remove {category['label']}. Select 'DONE' if no more {category['label']} to add.</i>",
+            reply_markup=rows(relevant_cell_members, ['REMOVE','DONE']),
+            parse_mode = 'HTML'
+        )
+
+        return category['choosing_state']
+
+    ## removing cell members
+    async def remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        user_data = context.user_data
+
+        ## reply
+        await update.message.reply_text(
+            f"<b>Okay, you want to remove names from the list of {category['label']}. Who would you like to remove?</b>\n"
+            f"{facts_to_str(user_data)}",
+            reply_markup=ReplyKeyboardMarkup([[name] for name in category_names(user_data, category)] + [['DONE']], one_time_keyboard=True),
+            parse_mode = 'HTML'
+        )
+
+        return category['removing_state']
+
+    ## Storing the information and asking for more cell members to remove
+    async def remove_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        user_data = context.user_data
+        text = update.message.text
+        selected = selection(user_data)
+        if selected.get(text) == category['attendance_type']:
+            del selected[text]
+
+        ## if the member to be removed is already in the database, then we must delete it.
+        if user_data['_recorded'].get(text) == category['attendance_type']:
+            del user_data['_recorded'][text]
+            if db.compact:
+                outbox.append([('put_session', session_payload(user_data, user_data['_recorded']))])
+            else:
+                outbox.append([('del_attendance', {'attendance_type': category['attendance_type'], 'name': text, 'cell_group': user_data['Cell'], 'event_type': user_data['Event Type'], 'date_attended': encode_date(clean_date(user_data))})])
+
+        ## reply
+        await update.message.reply_text(
+            "<b>Okay, I've removed the member. Who else would you like to remove?</b>\n"
+            f"{facts_to_str(user_data)}\n<i>Instructions: If you have finished removing, press 'DONE'.</i>",
+            reply_markup=ReplyKeyboardMarkup([[name] for name in category_names(user_data, category)] + [['DONE']], one_time_keyboard=True),
+            parse_mode = 'HTML'
+        )
+
+        return category['removing_state']
+
+    ## moving on to the next category, or finishing after the last one
+    async def next_(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        if n + 1 < len(LIST_CATEGORIES):
+            return await choose(n + 1, update, context)
+        return await done(update, context)
+
+    return received, picked, remove, remove_update, next_
+
+
+## committing a session
+def session_ops(user_data: Dict[str, str]) -> list:
+    """The outbox entries which record the whole session."""
+    ## prepare a clean attendance date
+    attendance_date = clean_date(user_data)
+    recorded = user_data.get('_recorded', {})
+
+    ## journal every list category in one outbox commit, in order; rows already recorded
+    ## with the same attendance type need no write
+    ops = []
+    if db.compact:
+        ## the compact format writes the whole session as one item
+        ops.append(('put_session', session_payload(user_data, selection(user_data))))
+    for category in LIST_CATEGORIES:
+        names = category_names(user_data, category)
+        for name in sorted(names):
+            if recorded.get(name) != category['attendance_type'] and not db.compact:
+                ops.append(('add_attendance', {'cell_group': user_data['Cell'], 'event_type': user_data['Event Type'], 'date_attended': encode_date(attendance_date), 'name': name, 'attendance_type': category['attendance_type']}))
+
+        if category['new_members']:
+            for name in [name for name in names if not roster.is_member(name)]:
+                ops.append(('add_new_member', {'name': name, 'role': 'New Friend', 'cell_group': user_data['Cell'], 'telegram_id': 'None', 'birth_date': '01-01-2000'}))
+                roster.add_member(Person(name, 'New Friend', user_data['Cell']))
+    return ops
+
+def commit_session(user_data: Dict[str, str]) -> None:
+    """Journal the whole session in one outbox commit."""
+    outbox.append(session_ops(user_data))
+
+def written(ops) -> None:
+    """Outbox callback: drop the cached exports and member summaries which written entries change.
+    New members go into the roster too (again, for entries journalled before a restart), as the
+    roster version they bump is taken without a rescan, see RosterLoader."""
+    for op, payload in ops:
+        if op == 'add_new_member':
+            roster.add_member(Person(payload['name'], payload['role'], payload['cell_group'], str(payload['telegram_id'])))
+            continue
+        exporter.invalidate(payload['cell_group'], payload['date_attended'])
+        if op == 'put_session':
+            ## a session item replaces the whole session, so anyone in the cell may have changed
+            member_history.invalidate(roster.cell_members(payload['cell_group']) + [name for names in payload['by_type'].values() for name in names])
+        else:
+            member_history.invalidate([payload['name']])
+
+
+def changed(change) -> None:
+    """Change feed listener: the same as written() for attendance written by another process or container."""
+    table, event_name, new_image, old_image = change
+    for image in (new_image, old_image):
+        if not image or table not in ('attendance', 'attendance_session'):
+            continue
+        exporter.invalidate(image['cell_group'], image['date_attended'])
+        if table == 'attendance_session':
+            member_history.invalidate(roster.cell_members(image['cell_group']))
+        else:
+            member_history.invalidate([image['name']])
+
+
+## done
+async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Display the gathered info and end the conversation."""
+    user_data = context.user_data
+    if '_backfill' in user_data:
+        return await done_backfill_session(update, context)
+    commit_session(user_data)
+    follow_up(update, context)
+
+    ## reply
+    await update.message.reply_text(
+        f"<b>Thank you {update.effective_user.first_name}. As a recap, I have collected these information:</b>\n {facts_to_str(user_data)}\n<b>{saved_text(user_data, 'I have proceeded to update their attendance.')}Type '/start' to begin a new attendance.</b>",
+        reply_markup=ReplyKeyboardRemove(),
+        parse_mode = 'HTML'
+    )
+
+    clear_session(user_data)
+    return ConversationHandler.END
+
+
+async def done_backfill_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Keep a finished backfill session for the final commit and open the next, or commit them all."""
+    user_data = context.user_data
+    backfill = user_data['_backfill']
+    backfill['ops'] += session_ops(user_data)
+    backfill['done'].append((user_data['Event Type'], user_data['Date'], [len(category_names(user_data, category)) for category in LIST_CATEGORIES]))
+    backfill['previous'][user_data['Event Type']] = session_of(user_data)
+    if backfill['queue']:
+        return await next_backfill_session(update, context)
+
+    ## every session of the backfill goes to the outbox in one commit
+    outbox.append(backfill['ops'])
+
+    summary = [
+        f"{event_type} on {date}: " + ", ".join(f"{category['key']} {count}" for category, count in zip(LIST_CATEGORIES, counts))
+        for event_type, date, counts in backfill['done']
+    ]
+    await update.message.reply_text(
+        f"<b>Thank you {update.effective_user.first_name}. I have updated {user_data['Cell']}'s attendance for {len(summary)} session(s):</b>\n"
+        + "\n".join(summary) + f"\n\n<b>{saved_text(user_data)}Type '/start' to begin a new attendance.</b>",
+        reply_markup=ReplyKeyboardRemove(),
+        parse_mode = 'HTML'
+    )
+
+    clear_session(user_data)
+    return ConversationHandler.END
+
+
+## follow-ups
+def follow_up(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Message the session's absentees in the background and tell the leader when it is done."""
+    messages = absentee_messages(context.user_data)
+    if not messages:
+        return
+    chat_id = update.effective_chat.id
+
+    async def progress(sent, failed, total):
+        logger.info("follow-ups for chat %s: %s sent, %s failed of %s", chat_id, sent, failed, total)
+        if sent + failed == total:
+            await context.bot.send_message(chat_id, f"I have sent follow-ups to {sent} of {total} absentee(s).")
+
+    broadcaster.start(context.application, messages, progress)
+
+
+async def remind_leaders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job callback which reminds every leader with a Telegram ID to take attendance."""
+    leaders = {person.name: person for role in LEADER_ROLES for person in roster.people_where(role=role)}
+    messages = [
+        (telegram_id, REMINDER_MESSAGE.format(name=name, cell=leaders[name].cell_group))
+        for name, telegram_id in sorted(roster.telegram_ids(leaders).items())
+    ]
+    await broadcaster.send(context.bot, messages)
+
+
+## bulk upload
+async def bulk_upload(n: int, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Record a whole CSV/XLSX attendance sheet, sent while choosing list category n, for the chosen session and reply with one summary."""
+    user_data = context.user_data
+    document = update.message.document
+    attendance_types = {word.lower(): category['attendance_type'] for category in LIST_CATEGORIES for word in (category['key'], category['label'], category['attendance_type'])}
+
+    ## the upload (at most Telegram's 20 MB) goes to a temp file and is parsed row by row off the event loop
+    with tempfile.TemporaryFile() as upload:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_memory(upload)
+        upload.seek(0)
+        try:
+            matched, unmatched, reported = await asyncio.to_thread(
+                parse_attendance, iter_rows(upload, document.file_name or ''), roster.match_name, attendance_types, LIST_CATEGORIES[0]['attendance_type']
+            )
+        except (ValueError, UnicodeDecodeError) as e:
+            await update.message.reply_text(f"Sorry, I could not read that file: {html.escape(str(e))}")
+            return LIST_CATEGORIES[n]['choosing_state']
+
+    ## an uploaded name moves out of any list it was already in
+    for category in LIST_CATEGORIES:
+        for name in sorted(matched.get(category['attendance_type'], set())):
+            select(user_data, name, category['attendance_type'])
+    ## in a backfill the upload fills this session and the backfill moves on to the next
+    if '_backfill' in user_data:
+        if unmatched:
+            await update.message.reply_text(f"{unmatched} row(s) of {html.escape(document.file_name or 'your file')} could not be matched and were skipped.")
+        return await done(update, context)
+    commit_session(user_data)
+    follow_up(update, context)
+
+    summary = [f"{category['key']}: {len(category_names(user_data, category))}" for category in LIST_CATEGORIES]
+    if unmatched:
+        summary.append(f"\n<b>{unmatched} row(s) could not be matched and were skipped:</b>")
+        summary += [f"row {line}: {html.escape(text)} ({html.escape(reason)})" for line, text, reason in reported]
+        if unmatched > len(reported):
+            summary.append(f"... and {unmatched - len(reported)} more")
+
+    ## reply
+    await update.message.reply_text(
+        f"<b>Thank you {update.effective_user.first_name}. I have recorded {user_data['Cell']}'s {user_data['Event Type']} attendance on {user_data['Date']} from {html.escape(document.file_name or 'your file')}:</b>\n"
+        + "\n".join(summary) + f"\n\n<b>{saved_text(user_data)}Type '/start' to begin a new attendance.</b>",
+        reply_markup=ReplyKeyboardRemove(),
+        parse_mode = 'HTML'
+    )
+
+    clear_session(user_data)
+    return ConversationHandler.END
+
+
+## restart
+async def exit_(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Display the gathered info and end the conversation."""
+    user_data = context.user_data
+
+    await update.message.reply_text(
+        "Type '/start' to begin a new attendance.",
+        )
+
+    clear_session(user_data)
+    return ConversationHandler.END
+
+
+## /export
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send a month of a cell's attendance as a CSV/XLSX document: /export [cell] [YYYY-MM] [csv|xlsx]."""
+    record = await asyncio.to_thread(auth.resolve, update.effective_user.id, context.user_data)
+    if not record['verified']:
+        await update.message.reply_text("Please type '/start' and verify yourself before exporting attendance.")
+        return
+
+    ## the arguments may come in any order; whatever is not a month or a format is the cell name
+    fmt, month, words = 'csv', datetime.now().strftime('%Y-%m'), []
+    for arg in context.args:
+        if arg.lower() in EXPORT_FORMATS:
+            fmt = arg.lower()
+        elif re.fullmatch(r'\d{4}-\d{2}', arg):
+            month = arg
+        else:
+            words.append(arg)
+    cell_group = ' '.join(words) or (record['person'].cell_group if record['person'] else None)
+    if not cell_group or not roster.has_cell(cell_group):
+        await update.message.reply_text(
+            "Which cell group? Usage: /export <cell> [YYYY-MM] [csv|xlsx]\nCell groups: " + ', '.join(roster.cell_groups())
+        )
+        return
+
+    try:
+        path, count = await asyncio.to_thread(exporter.export, cell_group, month, fmt)
+    except ValueError as e:
+        await update.message.reply_text(f"Sorry, I could not export that: {e}")
+        return
+    except UNAVAILABLE as e:
+        if not transient(e):
+            raise
+        await update.message.reply_text("Sorry, our database is busy right now. Please try again in a few minutes.")
+        return
+    with open(path, 'rb') as f:
+        await update.message.reply_document(f, filename=os.path.basename(path), caption=f"{cell_group}, {month}: {count} row(s)")
+
+
+## /myattendance
+async def myattendance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the caller their own recent attendance, found through their Telegram ID."""
+    record = await asyncio.to_thread(auth.resolve, update.effective_user.id, context.user_data)
+    if record['person'] is None:
+        await update.message.reply_text("Sorry, I don't know you yet. Please ask your cell leader to register your Telegram account.")
+        return
+
+    try:
+        summary = await asyncio.to_thread(member_history.summary, record['person'])
+    except UNAVAILABLE as e:
+        if not transient(e):
+            raise
+        await update.message.reply_text("Sorry, our database is busy right now. Please try again in a few minutes.")
+        return
+    await update.message.reply_text(summary, parse_mode = 'HTML')
+
+
+## /resume
+async def resume(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Continue a session which was put aside as a draft after going idle."""
+    user_data = context.user_data
+    draft = await asyncio.to_thread(drafts.pop, update.effective_user.id)
+    if draft is None:
+        await update.message.reply_text("You have no unfinished attendance. Type '/start' to begin a new attendance.")
+        return ConversationHandler.END
+
+    clear_session(user_data)
+    backfill = draft.pop('_backfill', None)
+    user_data.update(draft)
+    try:
+        recorded = await asyncio.to_thread(db.get_session_attendance, user_data['Cell'], user_data['Event Type'], clean_date(user_data))
+        if backfill is not None:
+            queued = await asyncio.to_thread(
+                db.get_sessions_attendance, user_data['Cell'], [(event_type, datetime.strptime(date, '%Y-%b-%d')) for event_type, date in backfill['queue']]
+            )
+    except UNAVAILABLE as e:
+        if not transient(e):
+            raise
+        logger.warning("could not read the resumed session, continuing without it", exc_info=True)
+        recorded, queued = AttendanceSession(user_data['Cell'], user_data['Event Type'], encode_date(clean_date(user_data))), {}
+        user_data['_degraded'] = True
+    user_data['_recorded'] = recorded.by_name()
+    if backfill is not None:
+        sessions_left = [tuple(session) for session in backfill['queue']]
+        user_data['_backfill'] = {
+            'queue': sessions_left,
+            'recorded': {
+                (event_type, date): queued.get((event_type, encode_date(datetime.strptime(date, '%Y-%b-%d'))), AttendanceSession(user_data['Cell'], event_type, encode_date(datetime.strptime(date, '%Y-%b-%d'))))
+                for event_type, date in sessions_left
+            },
+            'ops': [tuple(op) for op in backfill['ops']],
+            'done': [tuple(session) for session in backfill['done']],
+            'previous': {},
+        }
+
+    await update.message.reply_text("<i>Welcome back! Here is the attendance you left unfinished.</i>", parse_mode = 'HTML')
+    return await choose(0, update, context)
+
+
+## idle sessions
+async def timed_out(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """ConversationHandler.TIMEOUT callback: put the session aside once it had no reply for SESSION_TIMEOUT_SECONDS."""
+    if '_touched' not in context.user_data:
+        return  # already put aside, e.g. by an LRU eviction
+    if sessions.evict(update.effective_user.id, context.user_data, 'idle'):
+        await context.bot.send_message(
+            update.effective_chat.id,
+            "I have put your unfinished attendance aside as a draft. Type '/resume' to continue it, or '/start' to begin a new attendance.",
+            reply_markup=ReplyKeyboardRemove(),
+        )
+
+def tracked(callback, needs_session: bool):
+    """Wrap a conversation callback so it touches the user's session in the SessionTracker. A session
+    which needs its data but was put aside in the meantime (LRU eviction, or idle across a restart) ends
+    with a pointer to /resume instead."""
+    @functools.wraps(callback)
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        if needs_session and 'Cell' not in context.user_data:
+            sessions.finish(user_id)
+            await update.effective_message.reply_text(
+                "This attendance was put aside after a while without replies. Type '/resume' to continue it, or '/start' to begin a new attendance.",
+                reply_markup=ReplyKeyboardRemove(),
+            )
+            return ConversationHandler.END
+
+        evicted = sessions.touch(user_id, context.user_data)
+        if evicted:
+            context.application.mark_data_for_update_persistence(user_ids=evicted)
+        state = await callback(update, context)
+        if state == ConversationHandler.END:
+            sessions.finish(user_id)
+            context.user_data.pop('_touched', None)
+        return state
+    return handler
+
+def restarting(callback, refuse_in_progress: bool = False):
+    """Wrap an entry command for use as a fallback, so /start, /backfill and /resume also work mid-conversation,
+    e.g. after the session was evicted. A session still in progress is put aside as a draft first, never dropped.
+    Drafts are kept one per user, so with refuse_in_progress (/resume) a session which has reached the list
+    categories stays where it is instead: putting it aside would overwrite the very draft being resumed."""
+    @functools.wraps(callback)
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if refuse_in_progress and draft_of(context.user_data) is not None:
+            await update.message.reply_text(
+                "<i>You have an attendance in progress. Please finish it, or type '/exit' to drop it, before you '/resume' your saved one.</i>",
+                parse_mode = 'HTML'
+            )
+            return None
+        if park(update.effective_user.id, context.user_data):
+            await update.message.reply_text("<i>I have put your unfinished attendance aside as a draft. Type '/resume' to continue it later.</i>", parse_mode = 'HTML')
+        return await callback(update, context)
+    return handler
+
+def sweep_sessions(application, log_metrics: bool = False) -> None:
+    """Put aside every idle session and drop expired drafts. The memory metrics pickle every user's
+    state, so they are only logged when asked for (the periodic job), not after every update."""
+    evicted = sessions.sweep(application.user_data)
+    if evicted:
+        application.mark_data_for_update_persistence(user_ids=evicted)
+    drafts.prune()
+    if log_metrics:
+        logger.info("session metrics: %s", {**sessions.metrics(application.user_data), 'drafts': drafts.count()})
+
+async def sweep_idle_sessions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job callback for sweep_sessions(), which catches sessions whose timeout job was lost in a restart."""
+    sweep_sessions(context.application, log_metrics=True)
+
+
+## /sessions
+async def session_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admins only: how much conversation state the bot holds and how much it evicted."""
+    if not auth.is_admin(update.effective_user.id):
+        return
+    metrics = {**sessions.metrics(context.application.user_data), 'drafts': await asyncio.to_thread(drafts.count)}
+    await update.message.reply_text(
+        "<b>Conversation state</b>\n<pre>" + "\n".join(f"{key:20} {value}" for key, value in metrics.items()) + "</pre>",
+        parse_mode = 'HTML'
+    )
+
+
+## /outbox
+async def outbox_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admins only: pending and dead outbox entries; '/outbox retry' puts the dead ones back in the journal."""
+    if not auth.is_admin(update.effective_user.id):
+        return
+    if context.args and context.args[0].lower() == 'retry':
+        revived = await asyncio.to_thread(outbox.revive)
+        await update.message.reply_text(f"Put {revived} dead outbox entries back in the journal.")
+        return
+
+    pending = await asyncio.to_thread(outbox.pending)
+    count, entries = await asyncio.to_thread(outbox.dead)
+    lines = [f"{entry_id} {op} x{attempts}: {html.escape(str(payload))}" for entry_id, op, payload, attempts in entries]
+    await update.message.reply_text(
+        f"<b>Outbox</b>: {pending} pending, {count} dead" + ("\n<pre>" + "\n".join(lines) + "</pre>\nType '/outbox retry' to replay them." if lines else ""),
+        parse_mode = 'HTML'
+    )
+
+
+## /profile
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admins only: the hottest frames of the latest saved update profiles."""
+    if not auth.is_admin(update.effective_user.id):
+        return
+    if not profiler.enabled:
+        await update.message.reply_text("Profiling is off. Set PROFILE_DIR (and PROFILE_SLOW_MS or PROFILE_EVERY) and restart the bot.")
+        return
+
+    profiles, hot = await asyncio.to_thread(profiler.summarize)
+    if not hot:
+        await update.message.reply_text(f"No profiles saved in {profiler.directory} yet.")
+        return
+    lines = [f"{share:6.1%} {own:6d} {total:6d}  {html.escape(frame)}" for frame, own, total, share in hot]
+    await update.message.reply_text(
+        f"<b>Hottest frames of the last {profiles} profile(s)</b> (share, self, total samples):\n<pre>" + "\n".join(lines) + "</pre>",
+        parse_mode = 'HTML'
+    )
+
+
+## change feed
+async def poll_change_feed(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job callback which pushes newly streamed person changes into the roster."""
+    await asyncio.to_thread(feed.poll)
+    await asyncio.to_thread(roster_loader.revalidate)
+
+
+## archiving
+async def archive_old_attendance(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job callback which moves attendance past the archive horizon to attendance_archive, as the
+    scheduled (EventBridge) invocation does for Lambda. Local SQLite storage keeps every row."""
+    if hasattr(db, 'archive_attendance'):
+        logger.info("archived %s attendance rows", await asyncio.to_thread(db.archive_attendance))
+
+
+############################### ConversationHandler ###############################
+def build_conversation_handler(verification_code: str) -> ConversationHandler:
+    """Build the ConversationHandler from the spec above.
+
+    The roster is read once here; afterwards the change feed keeps it, the cell
+    keyboard and the cell filter fresh. Every other filter is compiled once."""
+    if not roster.loaded:
+        roster_loader.load()
+    cell_filter = CellGroupFilter()
+    control = filters.Text(CONTROL_WORDS)
+
+    states = {
+        LOGIN_REPLY: [
+            MessageHandler(filters.Regex(f"^({verification_code})$"), verified),
+        ],
+    }
+    for n, step in enumerate(SELECTION_STEPS[1:], start=1):
+        step_filter = cell_filter if step['options'] == 'cells' else filters.Text(step['options'])
+        states[step['state']] = [
+            MessageHandler(step_filter, make_selection_handler(n)),
+        ]
+    ## leaders who start with their own cell pre-selected may still switch cells by name
+    states[CHOOSING_EVENTTYPE].append(MessageHandler(cell_filter, make_selection_handler(CHOOSING_CELL)))
+
+    states[BACKFILL_DATES] = [
+        MessageHandler(filters.TEXT & ~filters.COMMAND, backfill_dates),
+    ]
+
+    for n, category in enumerate(LIST_CATEGORIES):
+        received, picked, remove, remove_update, next_ = make_category_handlers(n)
+        states[category['choosing_state']] = [
+            MessageHandler(filters.Document.FileExtension('csv') | filters.Document.FileExtension('xlsx'), functools.partial(bulk_upload, n)),
+            MessageHandler(filters.TEXT & ~(filters.COMMAND | control), received),
+            CallbackQueryHandler(picked, pattern='^pick:'),
+            MessageHandler(filters.Text(['REMOVE']), remove),
+            MessageHandler(filters.Text(['DONE', 'NONE']), next_),
+        ]
+        states[category['removing_state']] = [
+            MessageHandler(filters.TEXT & ~(filters.COMMAND | filters.Text(['DONE'])), remove_update),
+            MessageHandler(filters.Text(['DONE']), received),
+        ]
+
+    ## every callback touches the session; past the cell question they also need its data
+    for state, handlers in states.items():
+        for handler in handlers:
+            handler.callback = tracked(handler.callback, needs_session=state not in (LOGIN_REPLY, CHOOSING_CELL))
+    states[ConversationHandler.TIMEOUT] = [TypeHandler(Update, timed_out)]
+
+    return ConversationHandler(
+        entry_points=[
+            CommandHandler("start", tracked(start, needs_session=False)),
+            CommandHandler("backfill", tracked(backfill, needs_session=False)),
+            CommandHandler("resume", tracked(resume, needs_session=False)),
+        ],
+        states=states,
+        ## an evicted session leaves the conversation in its last state, where only fallbacks match
+        fallbacks=[
+            CommandHandler("exit", tracked(exit_, needs_session=False)),
+            CommandHandler("start", tracked(restarting(start), needs_session=False)),
+            CommandHandler("backfill", tracked(restarting(backfill), needs_session=False)),
+            CommandHandler("resume", tracked(restarting(resume, refuse_in_progress=True), needs_session=False)),
+        ],
+        name="attendance",
+        persistent=True,
+        conversation_timeout=sessions.timeout,
+    )
+
+
+def build_command_handlers() -> list:
+    """Commands which live outside the attendance conversation."""
+    return [
+        CommandHandler("export", export),
+        CommandHandler("myattendance", myattendance),
+        CommandHandler("outbox", outbox_status),
+        CommandHandler("profile", profile),
+        CommandHandler("sessions", session_metrics),
+    ]
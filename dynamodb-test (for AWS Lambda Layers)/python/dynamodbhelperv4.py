@@ -1,9 +1,352 @@
+import functools
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
 import boto3
 import pandas as pd
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+from models import AttendanceRecord, AttendanceSession, Person
+
+deserializer = TypeDeserializer()
+logger = logging.getLogger(__name__)
+
+################################### Client factory ###################################
+## boto3 clients are thread-safe and hold the connection pool, so one client per
+## configuration is shared by every helper, thread and handler in the process.
+_clients = {}
+_clients_lock = threading.Lock()
+
+def client_config(max_pool_connections=None, connect_timeout=None, read_timeout=None, max_attempts=None) -> Config:
+    """botocore Config with an explicit pool size, TCP keep-alive, adaptive retries and timeouts.
+    Unset values come from the DYNAMODB_* environment variables, then from the defaults below."""
+    return Config(
+        max_pool_connections=int(max_pool_connections or os.getenv('DYNAMODB_MAX_POOL_CONNECTIONS', 50)),
+        tcp_keepalive=True,
+        connect_timeout=float(connect_timeout or os.getenv('DYNAMODB_CONNECT_TIMEOUT', 2)),
+        read_timeout=float(read_timeout or os.getenv('DYNAMODB_READ_TIMEOUT', 5)),
+        retries={'mode': 'adaptive', 'max_attempts': int(max_attempts or os.getenv('DYNAMODB_MAX_ATTEMPTS', 5))},
+    )
+
+def get_client(service='dynamodb', endpoint_url=None, **config):
+    """The shared client for a service and configuration, created on first use.
+    endpoint_url (or DYNAMODB_ENDPOINT_URL) points at a local DynamoDB, e.g. http://localhost:8000."""
+    endpoint_url = endpoint_url or os.getenv('DYNAMODB_ENDPOINT_URL')
+    key = (service, endpoint_url, tuple(sorted(config.items())))
+    with _clients_lock:
+        if key not in _clients:
+            # sessions are not thread-safe, so each client gets its own, created under the lock
+            _clients[key] = boto3.session.Session().client(service, endpoint_url=endpoint_url, config=client_config(**config))
+        return _clients[key]
+
+def get_resource(endpoint_url=None, **config):
+    """A DynamoDB resource with the same tuned configuration, for notebooks and scripts."""
+    endpoint_url = endpoint_url or os.getenv('DYNAMODB_ENDPOINT_URL')
+    return boto3.session.Session().resource('dynamodb', endpoint_url=endpoint_url, config=client_config(**config))
+
+################################### Circuit breaker ###################################
+## When DynamoDB throttles or times out, the breaker opens and calls fail at once with
+## CircuitOpenError instead of each handler waiting out its own timeouts and retries.
+## Callers then degrade: rosters come from the in-memory cache or the /tmp snapshot and
+## writes wait in the outbox. After `cooldown` one probe call is let through (half-open);
+## the breaker closes when it succeeds.
+
+## errors which say DynamoDB is unhealthy, rather than that the request was wrong
+THROTTLING_ERRORS = {'ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded', 'InternalServerError', 'ServiceUnavailable'}
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling DynamoDB while the circuit breaker is open."""
+
+def is_transient(error) -> bool:
+    """Whether a failed call may succeed unchanged later (throttling, 5xx, network, open breaker),
+    as opposed to a request DynamoDB will keep refusing (e.g. a ValidationException)."""
+    if isinstance(error, (CircuitOpenError, BotoCoreError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response['Error'].get('Code') in THROTTLING_ERRORS or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    return False
+
+class CircuitBreaker:
+    """Opens when at least failure_rate of the last `window` calls failed or ran over latency_budget seconds."""
+
+    def __init__(self, window=None, failure_rate=None, latency_budget=None, cooldown=None, min_calls=5):
+        self.failure_rate = float(failure_rate or os.getenv('BREAKER_FAILURE_RATE', 0.5))
+        self.latency_budget = float(latency_budget or os.getenv('BREAKER_LATENCY_BUDGET', 3))
+        self.cooldown = float(cooldown or os.getenv('BREAKER_COOLDOWN', 30))
+        self.min_calls = min_calls
+        self.lock = threading.Lock()
+        self.results = deque(maxlen=int(window or os.getenv('BREAKER_WINDOW', 20)))   # True for a failed or slow call
+        self.state = 'closed'
+        self.opened = 0.0
+        self.probing = False
+
+    @property
+    def is_open(self):
+        """Whether DynamoDB is currently treated as unavailable (open or waiting on a probe)."""
+        with self.lock:
+            return self.state != 'closed'
+
+    def call(self, method, *args, **kwargs):
+        probe = self._before_call()
+        start = time.monotonic()
+        failed = True
+        try:
+            result = method(*args, **kwargs)
+            failed = time.monotonic() - start > self.latency_budget
+            return result
+        except Exception as e:
+            failed = is_transient(e)
+            raise
+        finally:
+            ## always settle the call, or an unexpected error would leave the probe outstanding forever
+            self._after_call(probe, failed)
+
+    def _before_call(self):
+        """Raise while open; returns whether this call is the half-open probe."""
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened >= self.cooldown:
+                self.state = 'half-open'
+            if self.state == 'open' or (self.state == 'half-open' and self.probing):
+                raise CircuitOpenError("DynamoDB is unavailable, the circuit breaker is open")
+            if self.state == 'half-open':
+                self.probing = True
+                return True
+            return False
+
+    def _after_call(self, probe, failed):
+        with self.lock:
+            if probe:
+                self.probing = False
+                if failed:
+                    self._trip()
+                else:
+                    self.state = 'closed'
+                    self.results.clear()
+                    logger.info("DynamoDB circuit breaker closed")
+                return
+            self.results.append(failed)
+            if self.state == 'closed' and len(self.results) >= self.min_calls and sum(self.results) >= self.failure_rate * len(self.results):
+                self._trip()
+
+    def _trip(self):
+        self.state = 'open'
+        self.opened = time.monotonic()
+        logger.warning("DynamoDB circuit breaker opened for %s s", self.cooldown)
+
+class GuardedClient:
+    """A boto3 client whose API calls, including each page a paginator fetches, go through a
+    CircuitBreaker; everything else passes through."""
+
+    def __init__(self, client, breaker):
+        self._client = client
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name in self._client.meta.method_to_api_mapping:
+            return functools.partial(self._breaker.call, attribute)
+        return attribute
+
+    def get_paginator(self, operation_name):
+        paginator = self._client.get_paginator(operation_name)
+        ## the paginator calls the raw client method it was created from for every page
+        paginator._method = functools.partial(self._breaker.call, paginator._method)
+        return paginator
+
+
+## attendance dates are stored as sortable ISO dates ('2024-07-01'), bucketed by month ('2024-07')
+DATE_FORMAT = '%Y-%m-%d'
+LEGACY_DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%b-%d', '%d/%m/%y', '%d/%m/%Y']
+CELL_MONTH_INDEX = 'cell_month-date_attended-index'
+NAME_DATE_INDEX = 'name-date_attended-index'
+TELEGRAM_ID_INDEX = 'telegram_id-index'
+
+def encode_date(date_attended) -> str:
+    """Normalize a datetime, date or date string (ISO, legacy or sharded key) into 'YYYY-MM-DD'."""
+    if isinstance(date_attended, (datetime, date)):
+        return date_attended.strftime(DATE_FORMAT)
+    text = str(date_attended).split('#')[0].strip()  # drop any write-shard suffix
+    for fmt in [DATE_FORMAT] + LEGACY_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime(DATE_FORMAT)
+        except ValueError:
+            pass
+    raise ValueError(f"unrecognised attendance date: {date_attended!r}")
+
+def month_bucket(date_attended) -> str:
+    """The 'YYYY-MM' bucket of an attendance date."""
+    return encode_date(date_attended)[:7]
+
+def month_buckets(start, end) -> list:
+    """Every 'YYYY-MM' bucket between two dates, inclusive, across years."""
+    year, month = int(month_bucket(start)[:4]), int(month_bucket(start)[5:])
+    buckets = []
+    while f'{year:04d}-{month:02d}' <= month_bucket(end):
+        buckets.append(f'{year:04d}-{month:02d}')
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return buckets
+
+def date_upper_bound(date_attended) -> str:
+    """Inclusive upper bound of a date range on date_attended: sorts after every shard suffix of the date."""
+    return encode_date(date_attended) + '~'
+
+def cell_month(cell_group, date_attended) -> str:
+    """Partition key of the cell history index: '<cell_group>#YYYY-MM'."""
+    return f'{cell_group}#{month_bucket(date_attended)}'
+
+## attendance rows older than the horizon are moved from attendance to attendance_archive
+ARCHIVE_TABLE = 'attendance_archive'
+
+def archive_horizon(days=None) -> str:
+    """The first date kept in the hot attendance table, ARCHIVE_AFTER_DAYS (default 365) days back."""
+    days = int(days or os.getenv('ARCHIVE_AFTER_DAYS', 365))
+    return encode_date(datetime.now() - timedelta(days=days))
+
+################################### Shadow reads ###################################
+## A new read path is rolled out by running it next to the one it replaces on a sample of
+## calls and comparing the results; the caller only ever waits for the legacy path.
+## Candidates are registered in SHADOW_READS as legacy method -> candidate method.
+SHADOW_READS = {
+    'get_legacy_session': 'get_indexed_session',
+}
+
+def canonical(result):
+    """A result with every list sorted, so two reads can be compared regardless of order."""
+    if isinstance(result, dict):
+        return {key: canonical(value) for key, value in result.items()}
+    if isinstance(result, (list, set, tuple)):
+        return sorted((canonical(value) for value in result), key=repr)
+    return result
+
+class ShadowReads:
+    """Runs candidate reads in the background on `fraction` of calls and records how they compare.
+
+    At most max_in_flight candidates run at once; calls beyond that are not shadowed, so a slow
+    candidate can never pile up work. Mismatches are logged with both results."""
+
+    def __init__(self, fraction=None, max_in_flight=4):
+        self.fraction = float(fraction if fraction is not None else os.getenv('SHADOW_READ_FRACTION', 0))
+        self.pool = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='dynamodb-shadow')
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.stats = {}   # legacy method -> counters, see record()
+
+    def wrap(self, name, legacy, candidate):
+        """legacy, with candidate run alongside it on a sample of calls."""
+        def read(*args, **kwargs):
+            if random.random() >= self.fraction or not self.slots.acquire(blocking=False):
+                return legacy(*args, **kwargs)
+
+            def shadow():
+                try:
+                    start = time.perf_counter()
+                    return candidate(*args, **kwargs), time.perf_counter() - start
+                finally:
+                    self.slots.release()
+            future = self.pool.submit(shadow)
+            start = time.perf_counter()
+            result = legacy(*args, **kwargs)
+            legacy_seconds = time.perf_counter() - start
+            future.add_done_callback(lambda done: self.record(name, args, result, legacy_seconds, done))
+            return result
+        return read
+
+    def record(self, name, args, result, legacy_seconds, done):
+        with self.lock:
+            stats = self.stats.setdefault(name, {'shadowed': 0, 'mismatches': 0, 'errors': 0, 'legacy_ms': 0.0, 'candidate_ms': 0.0})
+            stats['shadowed'] += 1
+        if done.exception() is not None:
+            logger.warning("shadow read %s%r failed: %r", SHADOW_READS[name], args, done.exception())
+            with self.lock:
+                stats['errors'] += 1
+            return
+
+        candidate_result, candidate_seconds = done.result()
+        matched = canonical(candidate_result) == canonical(result)
+        if not matched:
+            logger.warning("shadow read %s%r differs from %s: %r != %r", SHADOW_READS[name], args, name, candidate_result, result)
+        with self.lock:
+            stats['mismatches'] += not matched
+            stats['legacy_ms'] += legacy_seconds * 1000
+            stats['candidate_ms'] += candidate_seconds * 1000
+        if stats['shadowed'] % 100 == 0:
+            logger.info("shadow reads (shadowed, mismatches, errors, legacy ms, candidate ms): %s", self.summary())
+
+    def summary(self):
+        """{legacy method: (shadowed calls, mismatches, errors, mean legacy ms, mean candidate ms)}."""
+        with self.lock:
+            return {
+                name: (stats['shadowed'], stats['mismatches'], stats['errors'],
+                       stats['legacy_ms'] / max(stats['shadowed'] - stats['errors'], 1),
+                       stats['candidate_ms'] / max(stats['shadowed'] - stats['errors'], 1))
+                for name, stats in self.stats.items()
+            }
+
 
 class DynamoDBHelper:
-    def __init__(self):
-        self.client = boto3.client('dynamodb')#,endpoint_url="http://localhost:8000") 
+    def __init__(self, client=None, shards=None, compact=None, shadow=None, breaker=None):
+        ## every DynamoDB call goes through the circuit breaker, see CircuitBreaker
+        self.breaker = breaker or CircuitBreaker()
+        self.client = GuardedClient(client or get_client(), self.breaker)
+        ## write sharding of the attendance partition key: with shards > 1 every row of a date is
+        ## spread over 'YYYY-MM-DD#0' .. 'YYYY-MM-DD#<shards-1>' by a hash of the name, and reads of
+        ## a date gather all shards in parallel. Run migrate_dates() after changing it.
+        self.shards = int(shards or os.getenv('ATTENDANCE_SHARDS', 1))
+        self.pool = ThreadPoolExecutor(max_workers=max(self.shards, 4), thread_name_prefix='dynamodb-gather')
+        ## ATTENDANCE_FORMAT=compact stores each session as a single attendance_session item
+        self.compact = (os.getenv('ATTENDANCE_FORMAT', 'rows') == 'compact') if compact is None else compact
+        self.roster_versions = {}   # (cell_group, version) -> members; versions never change once written
+        self.latest_roster = {}     # cell_group -> latest version known to this process
+        ## SHADOW_READ_FRACTION > 0 compares the candidate read paths in SHADOW_READS with the legacy ones
+        self.shadow = shadow or ShadowReads()
+        ## history reads older than this many days also consult the archive, see archive_attendance()
+        self.archive_after_days = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+        ## roster versions produced by apply_ops() person writes, which the bot's roster already holds
+        self.own_roster_versions = set()
+        if self.shadow.fraction > 0:
+            for legacy, candidate in SHADOW_READS.items():
+                setattr(self, legacy, self.shadow.wrap(legacy, getattr(self, legacy), getattr(self, candidate)))
+
+    ## partition keys
+    def date_key(self, date_attended, name) -> str:
+        """The attendance partition key of one member's row on a date."""
+        if self.shards == 1:
+            return encode_date(date_attended)
+        return f'{encode_date(date_attended)}#{zlib.crc32(name.encode()) % self.shards}'
+
+    def date_keys(self, date_attended) -> list:
+        """Every attendance partition key holding rows of a date."""
+        if self.shards == 1:
+            return [encode_date(date_attended)]
+        return [f'{encode_date(date_attended)}#{shard}' for shard in range(self.shards)]
+
+    def _statement(self, stmt):
+        """Run a paginated PartiQL statement and return its raw items."""
+        items, kwargs = [], {}
+        while True:
+            response = self.client.execute_statement(Statement = stmt, **kwargs)
+            items += response['Items']
+            if 'NextToken' not in response:
+                return items
+            kwargs = {'NextToken': response['NextToken']}
+
+    def _gather(self, stmt, date_attended):
+        """Run a statement with a '{date_attended}' placeholder once per partition key of the date,
+        in parallel, and merge the items."""
+        keys = self.date_keys(date_attended)
+        if len(keys) == 1:
+            return self._statement(stmt.format(date_attended=keys[0]))
+        return [item for items in self.pool.map(lambda key: self._statement(stmt.format(date_attended=key)), keys) for item in items]
     
     def setup(self):
         if 'attendance' not in self.client.list_tables()['TableNames']:        
@@ -28,13 +371,130 @@ class DynamoDBHelper:
                         'AttributeName': 'name',
                         'AttributeType': 'S'
                     },
-
+                    {
+                        'AttributeName': 'cell_month',
+                        'AttributeType': 'S'
+                    },
                 ],
+                GlobalSecondaryIndexes=[self._date_index(CELL_MONTH_INDEX, 'cell_month'), self._date_index(NAME_DATE_INDEX, 'name')],
                 ProvisionedThroughput={
                     'ReadCapacityUnits': 1,
                     'WriteCapacityUnits': 1
+                },
+                StreamSpecification={
+                    'StreamEnabled': True,
+                    'StreamViewType': 'NEW_AND_OLD_IMAGES'
                 }
             )
+        self.setup_compact()
+        self.setup_archive()
+        if 'person' in self.client.list_tables()['TableNames']:
+            self.add_telegram_index()
+
+    def setup_archive(self):
+        """Create the cold attendance table: the same keys and history indexes as attendance, no stream."""
+        if ARCHIVE_TABLE not in self.client.list_tables()['TableNames']:
+            self.client.create_table(
+                TableName=ARCHIVE_TABLE,
+                KeySchema=[{'AttributeName': 'date_attended', 'KeyType': 'HASH'}, {'AttributeName': 'name', 'KeyType': 'RANGE'}],
+                AttributeDefinitions=[
+                    {'AttributeName': 'date_attended', 'AttributeType': 'S'},
+                    {'AttributeName': 'name', 'AttributeType': 'S'},
+                    {'AttributeName': 'cell_month', 'AttributeType': 'S'},
+                ],
+                GlobalSecondaryIndexes=[self._date_index(CELL_MONTH_INDEX, 'cell_month'), self._date_index(NAME_DATE_INDEX, 'name')],
+                ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1},
+            )
+
+    def setup_compact(self):
+        """Create the tables of the compact session format: one item per (cell, event type, date)
+        in attendance_session, and the append-only member lists its bitsets index into in roster_version.
+        Also creates the small meta table holding counters such as the roster version."""
+        existing = self.client.list_tables()['TableNames']
+        if 'meta' not in existing:
+            self.client.create_table(
+                TableName='meta',
+                KeySchema=[{'AttributeName': 'key', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'key', 'AttributeType': 'S'}],
+                ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1},
+            )
+        for table, partition_key, sort_key, sort_type in [
+            ('attendance_session', 'session_key', 'date_attended', 'S'),
+            ('roster_version', 'cell_group', 'version', 'N'),
+        ]:
+            if table in existing:
+                continue
+            self.client.create_table(
+                TableName=table,
+                KeySchema=[
+                    {'AttributeName': partition_key, 'KeyType': 'HASH'},
+                    {'AttributeName': sort_key, 'KeyType': 'RANGE'},
+                ],
+                AttributeDefinitions=[
+                    {'AttributeName': partition_key, 'AttributeType': 'S'},
+                    {'AttributeName': sort_key, 'AttributeType': sort_type},
+                ],
+                ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1},
+                ## the change feed reads it to drop caches outdated by other processes
+                **({'StreamSpecification': {'StreamEnabled': True, 'StreamViewType': 'NEW_AND_OLD_IMAGES'}} if table == 'attendance_session' else {}),
+            )
+
+    @staticmethod
+    def _date_index(index_name, partition_key):
+        return {
+            'IndexName': index_name,
+            'KeySchema': [
+                {'AttributeName': partition_key, 'KeyType': 'HASH'},
+                {'AttributeName': 'date_attended', 'KeyType': 'RANGE'},
+            ],
+            'Projection': {'ProjectionType': 'ALL'},
+            'ProvisionedThroughput': {'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1},
+        }
+
+    def add_date_indexes(self):
+        """Create the cell-month and member date indexes on an existing attendance table.
+
+        DynamoDB builds one index per update, so this waits for each to become active."""
+        existing = [index['IndexName'] for index in self.client.describe_table(TableName='attendance')['Table'].get('GlobalSecondaryIndexes', [])]
+        for index_name, partition_key in [(CELL_MONTH_INDEX, 'cell_month'), (NAME_DATE_INDEX, 'name')]:
+            if index_name in existing:
+                continue
+            self.client.update_table(
+                TableName='attendance',
+                AttributeDefinitions=[
+                    {'AttributeName': partition_key, 'AttributeType': 'S'},
+                    {'AttributeName': 'date_attended', 'AttributeType': 'S'},
+                ],
+                GlobalSecondaryIndexUpdates=[{'Create': self._date_index(index_name, partition_key)}],
+            )
+            self.client.get_waiter('table_exists').wait(TableName='attendance')
+            while any(index['IndexStatus'] != 'ACTIVE' for index in self.client.describe_table(TableName='attendance')['Table']['GlobalSecondaryIndexes']):
+                time.sleep(5)
+
+    def add_telegram_index(self):
+        """Create the telegram_id index on the person table, used to recognise returning users."""
+        existing = [index['IndexName'] for index in self.client.describe_table(TableName='person')['Table'].get('GlobalSecondaryIndexes', [])]
+        if TELEGRAM_ID_INDEX in existing:
+            return
+        self.client.update_table(
+            TableName='person',
+            AttributeDefinitions=[{'AttributeName': 'telegram_id', 'AttributeType': 'S'}],
+            GlobalSecondaryIndexUpdates=[{'Create': {
+                'IndexName': TELEGRAM_ID_INDEX,
+                'KeySchema': [{'AttributeName': 'telegram_id', 'KeyType': 'HASH'}],
+                'Projection': {'ProjectionType': 'ALL'},
+                'ProvisionedThroughput': {'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1},
+            }}],
+        )
+
+    def enable_streams(self, tables=('person', 'attendance', 'attendance_session')):
+        """Turn on NEW_AND_OLD_IMAGES streams for the change feed, on tables which do not have one yet."""
+        for table in tables:
+            if 'StreamSpecification' not in self.client.describe_table(TableName=table)['Table']:
+                self.client.update_table(
+                    TableName=table,
+                    StreamSpecification={'StreamEnabled': True, 'StreamViewType': 'NEW_AND_OLD_IMAGES'}
+                )
     
     # def add_item(self, item_text, owner):
     #     stmt = "INSERT INTO items VALUE {'owner': '" + '{}'.format(owner) + "', 'description': '" + '{}'.format(item_text) + "'}"
@@ -55,38 +515,537 @@ class DynamoDBHelper:
         result = pd.json_normalize(self.client.execute_statement(Statement = stmt)['Items'])
         return list(set([x[0] for x in result.values]))
 
+    def get_people(self):
+        """Return every person as a Person, in one paginated scan."""
+        stmt = "SELECT name, role, cell_group, telegram_id FROM person"
+        people, kwargs = [], {}
+        while True:
+            response = self.client.execute_statement(Statement = stmt, **kwargs)
+            people += [Person.from_item({key: value['S'] for key, value in item.items()}) for item in response['Items']]
+            if 'NextToken' not in response:
+                return people
+            kwargs = {'NextToken': response['NextToken']}
+
+    ## roster version counter, moved by every write to person so cached rosters know when to reload
+    def get_roster_version_counter(self):
+        """The roster version, 0 before its first bump, or None (unknown) when there is no meta table."""
+        try:
+            item = self.client.get_item(TableName='meta', Key={'key': {'S': 'roster_version'}}, ConsistentRead=True).get('Item')
+        except self.client.exceptions.ResourceNotFoundException:
+            logger.warning("no meta table, the roster version is unknown; run setup() to create it")
+            return None
+        return int(item['version']['N']) if item else 0
+
+    def bump_roster_version_counter(self):
+        """Move the roster version on and return the new one; call after writing to person outside this helper (e.g. the notebook)."""
+        return int(self.client.update_item(
+            TableName='meta',
+            Key={'key': {'S': 'roster_version'}},
+            UpdateExpression='ADD version :one',
+            ExpressionAttributeValues={':one': {'N': '1'}},
+            ReturnValues='UPDATED_NEW',
+        )['Attributes']['version']['N'])
+
+    def get_person_by_telegram_id(self, telegram_id):
+        """The person registered with a Telegram ID, through the telegram_id index, or None."""
+        items = self.client.query(
+            TableName='person',
+            IndexName=TELEGRAM_ID_INDEX,
+            KeyConditionExpression='telegram_id = :telegram_id',
+            ExpressionAttributeValues={':telegram_id': {'S': str(telegram_id)}},
+            Limit=1,
+        )['Items']
+        if not items:
+            return None
+        return Person.from_item({key: deserializer.deserialize(value) for key, value in items[0].items()})
+
     def get_cell_members(self, cell_group):
         stmt = "SELECT name FROM person WHERE cell_group = '{}'".format(cell_group)
         result = pd.json_normalize(self.client.execute_statement(Statement = stmt)['Items'])
         return list(set([x[0] for x in result.values]))
     
     def get_alr_entered_cell_members(self, cell_group, event_type, date_attended):
-        stmt = "SELECT name FROM attendance WHERE cell_group = '{}' and event_type = '{}' and date_attended = '{}'".format(cell_group, event_type, date_attended)
-        result = pd.json_normalize(self.client.execute_statement(Statement = stmt)['Items'])
-        return list(set([x[0] for x in result.values]))
+        stmt = "SELECT name FROM attendance WHERE cell_group = '" + cell_group + "' and event_type = '" + event_type + "' and date_attended = '{date_attended}'"
+        return list(set([item['name']['S'] for item in self._gather(stmt, date_attended)]))
     
+    def get_session_attendance(self, cell_group, event_type, date_attended) -> AttendanceSession:
+        """Return every recorded name of one session, grouped by attendance type, in a single query."""
+        if self.compact:
+            return self.get_session(cell_group, event_type, date_attended)
+        return self.get_legacy_session(cell_group, event_type, date_attended)
+
+    def get_legacy_session(self, cell_group, event_type, date_attended):
+        """The session read from per-person attendance rows; a date past the archive horizon is read
+        from the archive too, through get_indexed_session."""
+        if encode_date(date_attended) < archive_horizon(self.archive_after_days):
+            return self.get_indexed_session(cell_group, event_type, date_attended)
+        stmt = "SELECT name, attendance_type FROM attendance WHERE cell_group = '" + cell_group + "' and event_type = '" + event_type + "' and date_attended = '{date_attended}'"
+        session = {}
+        for item in self._gather(stmt, date_attended):
+            session.setdefault(item['attendance_type']['S'], set()).add(item['name']['S'])
+        return AttendanceSession.from_types(cell_group, event_type, encode_date(date_attended), session)
+
+    def get_indexed_session(self, cell_group, event_type, date_attended):
+        """The same session as get_legacy_session, read with one key-range query on the cell history index."""
+        session = {}
+        for row in self._tiered_query(date_attended,
+            IndexName=CELL_MONTH_INDEX,
+            KeyConditionExpression='cell_month = :cell_month AND date_attended BETWEEN :start AND :end',
+            FilterExpression='event_type = :event_type',
+            ExpressionAttributeValues={':cell_month': {'S': cell_month(cell_group, date_attended)}, ':start': {'S': encode_date(date_attended)}, ':end': {'S': date_upper_bound(date_attended)}, ':event_type': {'S': event_type}},
+        ):
+            session.setdefault(row['attendance_type'], set()).add(row['name'])
+        return AttendanceSession.from_types(cell_group, event_type, encode_date(date_attended), session)
+
+    def get_alr_cell_members_by_type(self, attendance_type, cell_group, event_type, date_attended):
+        stmt = "SELECT name FROM attendance WHERE attendance_type = '" + attendance_type + "' and cell_group = '" + cell_group + "' and event_type = '" + event_type + "' and date_attended = '{date_attended}'"
+        return list(set([item['name']['S'] for item in self._gather(stmt, date_attended)]))
+
+    def del_alr_cell_members_by_type(self, attendance_type, name, cell_group, event_type, date_attended):
+        stmt = "DELETE FROM attendance WHERE attendance_type = '{}' and name = '{}' and cell_group = '{}' and event_type = '{}' and date_attended = '{}'".format(attendance_type, name, cell_group, event_type, self.date_key(date_attended, name))
+        self.client.execute_statement(Statement = stmt)
+
     def get_alr_attended_cell_members(self, cell_group, event_type, date_attended):
-        stmt = "SELECT name FROM attendance WHERE attendance_type = 'Present' and cell_group = '{}' and event_type = '{}' and date_attended = '{}'".format(cell_group, event_type, date_attended)
-        result = pd.json_normalize(self.client.execute_statement(Statement = stmt)['Items'])
-        return list(set([x[0] for x in result.values]))
+        return self.get_alr_cell_members_by_type('Present', cell_group, event_type, date_attended)
     
     def get_alr_absentvalid_cell_members(self, cell_group, event_type, date_attended):
-        stmt = "SELECT name FROM attendance WHERE attendance_type = 'Absent Valid' and cell_group = '{}' and event_type = '{}' and date_attended = '{}'".format(cell_group, event_type, date_attended)
-        result = pd.json_normalize(self.client.execute_statement(Statement = stmt)['Items'])
-        return list(set([x[0] for x in result.values]))
+        return self.get_alr_cell_members_by_type('Absent Valid', cell_group, event_type, date_attended)
     
     def del_alr_attended_cell_members(self, name, cell_group, event_type, date_attended):
-        stmt = "DELETE FROM attendance WHERE attendance_type = 'Present' and name = '{}' and cell_group = '{}' and event_type = '{}' and date_attended = '{}'".format(name, cell_group, event_type, date_attended)
-        self.client.execute_statement(Statement = stmt)
+        self.del_alr_cell_members_by_type('Present', name, cell_group, event_type, date_attended)
     
     def del_alr_absentvalid_cell_members(self, name, cell_group, event_type, date_attended):
-        stmt = "DELETE FROM attendance WHERE attendance_type = 'Absent Valid' and name = '{}' and cell_group = '{}' and event_type = '{}' and date_attended = '{}'".format(name, cell_group, event_type, date_attended)
-        self.client.execute_statement(Statement = stmt)
+        self.del_alr_cell_members_by_type('Absent Valid', name, cell_group, event_type, date_attended)
     
     def add_attendance(self, cell_group, event_type, date_attended, name, attendance_type):
-        stmt = "INSERT INTO attendance VALUE {'cell_group': '" + '{}'.format(cell_group) + "', 'event_type': '" + '{}'.format(event_type) + "', 'date_attended': '" + '{}'.format(date_attended) + "', 'name': '" + '{}'.format(name) + "', 'attendance_type': '" + '{}'.format(attendance_type) + "'}"
+        stmt = "INSERT INTO attendance VALUE {'cell_group': '" + '{}'.format(cell_group) + "', 'event_type': '" + '{}'.format(event_type) + "', 'date_attended': '" + '{}'.format(self.date_key(date_attended, name)) + "', 'month_bucket': '" + '{}'.format(month_bucket(date_attended)) + "', 'cell_month': '" + '{}'.format(cell_month(cell_group, date_attended)) + "', 'name': '" + '{}'.format(name) + "', 'attendance_type': '" + '{}'.format(attendance_type) + "'}"
         self.client.execute_statement(Statement = stmt)
 
     def add_new_member(self, name, role, cell_group, telegram_id, birth_date):
         stmt = "INSERT INTO person VALUE {'name': '" + '{}'.format(name) + "', 'role': '" + '{}'.format(role) + "', 'cell_group': '" + '{}'.format(cell_group) + "', 'telegram_id': '" + '{}'.format(telegram_id) + "', 'birth_date': '" + '{}'.format(birth_date) + "'}"
-        self.client.execute_statement(Statement = stmt)
\ No newline at end of file
+        self.client.execute_statement(Statement = stmt)
+        self.bump_roster_version_counter()
+
+    ## batched writes
+    def attendance_item(self, cell_group, event_type, date_attended, name, attendance_type):
+        """The attendance row written by add_attendance, in DynamoDB attribute-value form."""
+        return {
+            'cell_group': {'S': cell_group},
+            'event_type': {'S': event_type},
+            'date_attended': {'S': self.date_key(date_attended, name)},
+            'month_bucket': {'S': month_bucket(date_attended)},
+            'cell_month': {'S': cell_month(cell_group, date_attended)},
+            'name': {'S': name},
+            'attendance_type': {'S': attendance_type},
+        }
+
+    @staticmethod
+    def person_item(name, role, cell_group, telegram_id, birth_date):
+        """The person row written by add_new_member, in DynamoDB attribute-value form."""
+        return {
+            'name': {'S': name},
+            'role': {'S': role},
+            'cell_group': {'S': cell_group},
+            'telegram_id': {'S': str(telegram_id)},
+            'birth_date': {'S': birth_date},
+        }
+
+    def apply_ops(self, ops):
+        """Apply journalled writes in order: runs of puts go out as BatchWriteItem calls of up to 25,
+        deletes run one at a time with the same conditions as del_alr_cell_members_by_type, and
+        compact sessions are written as one item each.
+
+        ops is a list of (op, payload) with op in 'add_attendance', 'add_new_member', 'del_attendance',
+        'put_session' and payload the keyword arguments of the matching helper method."""
+        puts = {}
+
+        def flush():
+            requests = list(puts.values())
+            puts.clear()
+            for i in range(0, len(requests), 25):
+                batch = {}
+                for table, request in requests[i:i+25]:
+                    batch.setdefault(table, []).append(request)
+                self._batch_write(batch)
+
+        people_written = False
+        horizon = archive_horizon(self.archive_after_days)
+        for op, payload in ops:
+            if op == 'add_attendance':
+                item = self.attendance_item(**payload)
+                ## a batch may not hold two writes to one key, the later write wins
+                puts[('attendance', item['date_attended']['S'], item['name']['S'])] = ('attendance', {'PutRequest': {'Item': item}})
+            elif op == 'add_new_member':
+                item = self.person_item(**payload)
+                puts[('person', item['name']['S'], item['role']['S'])] = ('person', {'PutRequest': {'Item': item}})
+                people_written = True
+            elif op == 'put_session':
+                flush()
+                self.put_session(**payload)
+            elif op == 'del_attendance':
+                flush()
+                self._delete_attendance('attendance', payload)
+                ## an archived row is deleted where it now lives, or the removal would be lost
+                if encode_date(payload['date_attended']) < horizon:
+                    self._delete_attendance(ARCHIVE_TABLE, payload)
+            else:
+                raise ValueError(f"unknown outbox operation: {op!r}")
+        flush()
+        if people_written:
+            self.own_roster_versions.add(self.bump_roster_version_counter())
+
+    def _delete_attendance(self, table, payload):
+        """One del_attendance of apply_ops, with the same conditions as del_alr_cell_members_by_type."""
+        try:
+            self.client.delete_item(
+                TableName=table,
+                Key={'date_attended': {'S': self.date_key(payload['date_attended'], payload['name'])}, 'name': {'S': payload['name']}},
+                ConditionExpression='attendance_type = :attendance_type AND cell_group = :cell_group AND event_type = :event_type',
+                ExpressionAttributeValues={
+                    ':attendance_type': {'S': payload['attendance_type']},
+                    ':cell_group': {'S': payload['cell_group']},
+                    ':event_type': {'S': payload['event_type']},
+                },
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass  # nothing recorded for this session, so nothing to delete
+        except self.client.exceptions.ResourceNotFoundException:
+            if table == 'attendance':
+                raise
+            ## no archive table, so nothing was ever archived
+
+    ## compact session format
+    @staticmethod
+    def session_key(cell_group, event_type) -> str:
+        return f'{cell_group}#{event_type}'
+
+    @staticmethod
+    def encode_bitset(names, members) -> bytes:
+        """A bitset over a roster version's member list: bit i is set when members[i] is in names."""
+        position = {member: i for i, member in enumerate(members)}
+        bits = 0
+        for name in names:
+            bits |= 1 << position[name]
+        return bits.to_bytes((len(members) + 7) // 8 or 1, 'little')
+
+    @staticmethod
+    def decode_bitset(bitset, members) -> list:
+        bits = int.from_bytes(bitset, 'little')
+        return [member for i, member in enumerate(members) if bits >> i & 1]
+
+    def get_roster_version(self, cell_group, version):
+        """The member list of one roster version, read once and then cached for good."""
+        if (cell_group, version) not in self.roster_versions:
+            item = self.client.get_item(
+                TableName='roster_version',
+                Key={'cell_group': {'S': cell_group}, 'version': {'N': str(version)}},
+                ConsistentRead=True,
+            )['Item']
+            self.roster_versions[(cell_group, version)] = [member['S'] for member in item['members']['L']]
+        return self.roster_versions[(cell_group, version)]
+
+    def ensure_roster_version(self, cell_group, names):
+        """A roster version of the cell holding every one of names, appending a new version if needed.
+
+        Versions only ever append names, so any version holding the names can encode the session."""
+        while True:
+            version = self.latest_roster.get(cell_group)
+            members = self.get_roster_version(cell_group, version) if version else []
+            missing = sorted(set(names) - set(members))
+            if version and not missing:
+                return version, members
+
+            if version is None:
+                ## find the newest version written by any process
+                latest = self.client.query(
+                    TableName='roster_version',
+                    KeyConditionExpression='cell_group = :cell_group',
+                    ExpressionAttributeValues={':cell_group': {'S': cell_group}},
+                    ScanIndexForward=False, Limit=1, ConsistentRead=True,
+                )['Items']
+                if latest:
+                    self.latest_roster[cell_group] = int(latest[0]['version']['N'])
+                    self.roster_versions[(cell_group, self.latest_roster[cell_group])] = [member['S'] for member in latest[0]['members']['L']]
+                    continue
+                version = 0
+
+            try:
+                self.client.put_item(
+                    TableName='roster_version',
+                    Item={'cell_group': {'S': cell_group}, 'version': {'N': str(version + 1)}, 'members': {'L': [{'S': member} for member in members + missing]}},
+                    ConditionExpression='attribute_not_exists(version)',
+                )
+                self.roster_versions[(cell_group, version + 1)] = members + missing
+                self.latest_roster[cell_group] = version + 1
+            except self.client.exceptions.ConditionalCheckFailedException:
+                self.latest_roster.pop(cell_group, None)  # another process appended first, re-read
+
+    def encode_session(self, cell_group, event_type, date_attended, by_type) -> dict:
+        """The attendance_session item of one session: one bitset per attendance type."""
+        version, members = self.ensure_roster_version(cell_group, [name for names in by_type.values() for name in names])
+        return {
+            'session_key': {'S': self.session_key(cell_group, event_type)},
+            'date_attended': {'S': encode_date(date_attended)},
+            'cell_group': {'S': cell_group},
+            'event_type': {'S': event_type},
+            'roster_version': {'N': str(version)},
+            'types': {'M': {attendance_type: {'B': self.encode_bitset(names, members)} for attendance_type, names in by_type.items() if names}},
+        }
+
+    def decode_session(self, item) -> dict:
+        """Turn an attendance_session item back into {attendance_type: [names]}."""
+        members = self.get_roster_version(item['cell_group']['S'], int(item['roster_version']['N']))
+        return {attendance_type: self.decode_bitset(bitset['B'], members) for attendance_type, bitset in item['types']['M'].items()}
+
+    def put_session(self, cell_group, event_type, date_attended, by_type, merge=False):
+        """Write a whole session as a single item. With merge, names already recorded for the session
+        and not in by_type are kept, for sessions taken while the stored one could not be read."""
+        if merge:
+            recorded = self.get_session(cell_group, event_type, date_attended).by_name()
+            recorded.update({name: attendance_type for attendance_type, names in by_type.items() for name in names})
+            by_type = {}
+            for name, attendance_type in recorded.items():
+                by_type.setdefault(attendance_type, []).append(name)
+        self.client.put_item(TableName='attendance_session', Item=self.encode_session(cell_group, event_type, date_attended, by_type))
+
+    def get_session(self, cell_group, event_type, date_attended) -> dict:
+        """Read a whole session as a single item, falling back to legacy per-person rows."""
+        item = self.client.get_item(
+            TableName='attendance_session',
+            Key={'session_key': {'S': self.session_key(cell_group, event_type)}, 'date_attended': {'S': encode_date(date_attended)}},
+        ).get('Item')
+        if item is not None:
+            return AttendanceSession.from_types(cell_group, event_type, encode_date(date_attended), self.decode_session(item))
+        return self.get_legacy_session(cell_group, event_type, date_attended)
+
+    def get_previous_session(self, cell_group, event_type, date_attended, lookback_days=None):
+        """The latest session of the cell and event type before date_attended, or None if there is
+        none in the last lookback_days (PREFILL_LOOKBACK_DAYS, 35 by default).
+
+        A compact session is one descending Query with Limit=1. Legacy rows are read newest first
+        from the cell history index (and the archive's), a month bucket at a time, until the date changes."""
+        before = encode_date(date_attended)
+        start = encode_date(datetime.strptime(before, DATE_FORMAT) - timedelta(days=int(lookback_days or os.getenv('PREFILL_LOOKBACK_DAYS', 35))))
+        if self.compact:
+            items = self.client.query(
+                TableName='attendance_session',
+                KeyConditionExpression='session_key = :session_key AND date_attended BETWEEN :start AND :end',
+                ExpressionAttributeValues={':session_key': {'S': self.session_key(cell_group, event_type)}, ':start': {'S': start}, ':end': {'S': encode_date(datetime.strptime(before, DATE_FORMAT) - timedelta(days=1))}},
+                ScanIndexForward=False, Limit=1,
+            )['Items']
+            if items:
+                return AttendanceSession.from_types(cell_group, event_type, items[0]['date_attended']['S'], self.decode_session(items[0]))
+
+        for bucket in reversed(month_buckets(start, before)):
+            latest, session = None, {}
+            for row in self._tiered_query(start, newest_first=True,
+                IndexName=CELL_MONTH_INDEX,
+                KeyConditionExpression='cell_month = :cell_month AND date_attended < :before',
+                FilterExpression='event_type = :event_type',
+                ExpressionAttributeValues={':cell_month': {'S': f'{cell_group}#{bucket}'}, ':before': {'S': before}, ':event_type': {'S': event_type}},
+                ScanIndexForward=False, Limit=50,
+            ):
+                if row['date_attended'] < start or latest not in (None, row['date_attended']):
+                    break
+                latest = row['date_attended']
+                session.setdefault(row['attendance_type'], set()).add(row['name'])
+            if latest is not None:
+                return AttendanceSession.from_types(cell_group, event_type, latest, session)
+        return None
+
+    def get_sessions_attendance(self, cell_group, sessions) -> dict:
+        """Several sessions of one cell in a few batched reads, for backfills.
+
+        sessions is a list of (event_type, date_attended); returns {(event_type, 'YYYY-MM-DD'):
+        AttendanceSession} with an entry for every session. Compact sessions are read with
+        BatchGetItem, the rest with one cell history query per month bucket."""
+        wanted = {(event_type, encode_date(date_attended)) for event_type, date_attended in sessions}
+        found = {}
+        if self.compact:
+            keys = [{'session_key': {'S': self.session_key(cell_group, event_type)}, 'date_attended': {'S': date_attended}} for event_type, date_attended in sorted(wanted)]
+            for i in range(0, len(keys), 100):
+                request, delay = {'attendance_session': {'Keys': keys[i:i+100]}}, 0.05
+                while request:
+                    response = self.client.batch_get_item(RequestItems=request)
+                    for item in response['Responses'].get('attendance_session', []):
+                        found[(item['event_type']['S'], item['date_attended']['S'])] = AttendanceSession.from_types(
+                            cell_group, item['event_type']['S'], item['date_attended']['S'], self.decode_session(item)
+                        )
+                    request = response.get('UnprocessedKeys')
+                    if request:
+                        time.sleep(delay)
+                        delay = min(delay * 2, 5)
+
+        legacy = {}
+        for bucket in sorted({date_attended[:7] for _, date_attended in wanted - set(found)}):
+            dates = sorted(date_attended for _, date_attended in wanted - set(found) if date_attended.startswith(bucket))
+            for row in self._tiered_query(dates[0],
+                IndexName=CELL_MONTH_INDEX,
+                KeyConditionExpression='cell_month = :cell_month AND date_attended BETWEEN :start AND :end',
+                ExpressionAttributeValues={':cell_month': {'S': f'{cell_group}#{bucket}'}, ':start': {'S': dates[0]}, ':end': {'S': date_upper_bound(dates[-1])}},
+            ):
+                if (row['event_type'], row['date_attended']) in wanted:
+                    legacy.setdefault((row['event_type'], row['date_attended']), {}).setdefault(row['attendance_type'], set()).add(row['name'])
+        for event_type, date_attended in wanted - set(found):
+            found[(event_type, date_attended)] = AttendanceSession.from_types(cell_group, event_type, date_attended, legacy.get((event_type, date_attended), {}))
+        return found
+
+    ## range queries
+    def _query(self, table='attendance', **kwargs):
+        """Run a paginated Query and yield its items as plain dicts, one page in memory at a time."""
+        while True:
+            response = self.client.query(TableName=table, **kwargs)
+            for item in response['Items']:
+                row = {key: deserializer.deserialize(value) for key, value in item.items()}
+                row['date_attended'] = encode_date(row['date_attended'])
+                yield row
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _tiered_query(self, start, newest_first=False, **kwargs):
+        """_query over the hot table and, when the range starts before the archive horizon, the archive too.
+
+        Both tables return rows in date order (newest first for a descending query), so the two
+        streams are merged a date at a time. A row kept in both, such as an edit of an archived
+        session or a row caught between its archive copy and its hot delete, comes from the hot table."""
+        if encode_date(start) >= archive_horizon(self.archive_after_days):
+            yield from self._query(**kwargs)
+            return
+
+        def by_date(rows):
+            return ((date_attended, list(group)) for date_attended, group in itertools.groupby(rows, key=lambda row: row['date_attended']))
+
+        def before(a, b):
+            return a > b if newest_first else a < b
+
+        hot, archived = by_date(self._query(**kwargs)), by_date(self._query(table=ARCHIVE_TABLE, **kwargs))
+        hot_date, archived_date = next(hot, None), next(archived, None)
+        while hot_date is not None or archived_date is not None:
+            if archived_date is None or (hot_date is not None and before(hot_date[0], archived_date[0])):
+                yield from hot_date[1]
+                hot_date = next(hot, None)
+            elif hot_date is None or before(archived_date[0], hot_date[0]):
+                yield from archived_date[1]
+                archived_date = next(archived, None)
+            else:
+                names = {row['name'] for row in hot_date[1]}
+                yield from (row for row in archived_date[1] if row['name'] not in names)
+                yield from hot_date[1]
+                hot_date, archived_date = next(hot, None), next(archived, None)
+
+    def get_member_history(self, name, start, end):
+        """Every AttendanceRecord of one member between two dates (inclusive), as one key-range query."""
+        return list(map(AttendanceRecord.from_item, self._tiered_query(start,
+            IndexName=NAME_DATE_INDEX,
+            KeyConditionExpression='#name = :name AND date_attended BETWEEN :start AND :end',
+            ExpressionAttributeNames={'#name': 'name'},
+            ExpressionAttributeValues={':name': {'S': name}, ':start': {'S': encode_date(start)}, ':end': {'S': date_upper_bound(end)}},
+        )))
+
+    def get_cell_history(self, cell_group, start, end, event_type=None):
+        """Every AttendanceRecord of one cell between two dates (inclusive), one key-range query per month bucket."""
+        return list(self.iter_cell_history(cell_group, start, end, event_type))
+
+    def iter_compact_sessions(self, cell_group, start, end, event_types):
+        """Stream the compact sessions (see put_session) of one cell between two dates as
+        AttendanceSessions: one item per session, whatever the size of the cell."""
+        for event_type in event_types:
+            for item in self.client.get_paginator('query').paginate(
+                TableName='attendance_session',
+                KeyConditionExpression='session_key = :session_key AND date_attended BETWEEN :start AND :end',
+                ExpressionAttributeValues={':session_key': {'S': self.session_key(cell_group, event_type)}, ':start': {'S': encode_date(start)}, ':end': {'S': date_upper_bound(end)}},
+            ).search('Items'):
+                yield AttendanceSession.from_types(cell_group, event_type, item['date_attended']['S'], self.decode_session(item))
+
+    def iter_cell_history(self, cell_group, start, end, event_type=None, event_types=()):
+        """Stream the AttendanceRecords of one cell between two dates, page by page.
+
+        With compact sessions on (see put_session), those of the given event_types are decoded into
+        records first. A session stored both ways (rows written before compact sessions were turned
+        on) comes from its compact item only, so it is never counted twice."""
+        compacted = set()   # (event_type, date) of every compact session yielded
+        if self.compact:
+            for session in self.iter_compact_sessions(cell_group, start, end, [event_type] if event_type is not None else event_types):
+                compacted.add((session.event_type, session.date_attended))
+                yield from session.records()
+
+        for bucket in month_buckets(start, end):
+            for row in self._tiered_query(start,
+                IndexName=CELL_MONTH_INDEX,
+                KeyConditionExpression='cell_month = :cell_month AND date_attended BETWEEN :start AND :end',
+                ExpressionAttributeValues={':cell_month': {'S': f'{cell_group}#{bucket}'}, ':start': {'S': encode_date(start)}, ':end': {'S': date_upper_bound(end)}},
+            ):
+                if (event_type is None or row['event_type'] == event_type) and (row['event_type'], row['date_attended']) not in compacted:
+                    yield AttendanceRecord.from_item(row)
+
+    ## migration
+    def migrate_dates(self):
+        """Rewrite attendance rows stored with legacy dates ('2024-07-01 00:00:00') or under another
+        shard count into the current ISO date, shard and month bucket encoding. date_attended is the
+        partition key, so a changed row is written under its new key and the old item deleted.
+        Returns the number of rows rewritten."""
+        rewritten = 0
+        kwargs = {'TableName': 'attendance'}
+        while True:
+            response = self.client.scan(**kwargs)
+            requests = []
+            for item in response['Items']:
+                row = {key: deserializer.deserialize(value) for key, value in item.items()}
+                iso_date = encode_date(row['date_attended'])
+                new_key = self.date_key(iso_date, row['name'])
+                if new_key == row['date_attended'] and row.get('cell_month') == cell_month(row['cell_group'], iso_date):
+                    continue
+                new_item = dict(item)
+                new_item['date_attended'] = {'S': new_key}
+                new_item['month_bucket'] = {'S': month_bucket(iso_date)}
+                new_item['cell_month'] = {'S': cell_month(row['cell_group'], iso_date)}
+                requests.append({'PutRequest': {'Item': new_item}})
+                if new_key != row['date_attended']:
+                    requests.append({'DeleteRequest': {'Key': {'date_attended': item['date_attended'], 'name': item['name']}}})
+                rewritten += 1
+            for i in range(0, len(requests), 25):
+                self._batch_write({'attendance': requests[i:i+25]})
+            if 'LastEvaluatedKey' not in response:
+                return rewritten
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    ## hot/cold tiering
+    def archive_attendance(self, before=None, writes_per_second=None):
+        """Move attendance rows dated before `before` (default: archive_horizon()) to attendance_archive.
+
+        Pages of the scan are copied to the archive first and then deleted from the hot table, so an
+        interrupted run is simply resumed by the next one. Writes are paced at writes_per_second
+        (ARCHIVE_WRITES_PER_SECOND, default 25) to leave the tables' capacity to the bot.
+        Returns the number of rows moved."""
+        before = encode_date(before) if before is not None else archive_horizon(self.archive_after_days)
+        writes_per_second = float(writes_per_second or os.getenv('ARCHIVE_WRITES_PER_SECOND', 25))
+        moved = 0
+        kwargs = {
+            'TableName': 'attendance',
+            'FilterExpression': 'date_attended < :before',
+            'ExpressionAttributeValues': {':before': {'S': before}},
+            'Limit': 100,
+        }
+        while True:
+            response = self.client.scan(**kwargs)
+            items = response['Items']
+            for i in range(0, len(items), 25):
+                started = time.monotonic()
+                batch = items[i:i+25]
+                self._batch_write({ARCHIVE_TABLE: [{'PutRequest': {'Item': item}} for item in batch]})
+                self._batch_write({'attendance': [{'DeleteRequest': {'Key': {'date_attended': item['date_attended'], 'name': item['name']}}} for item in batch]})
+                moved += len(batch)
+                time.sleep(max(0.0, 2 * len(batch) / writes_per_second - (time.monotonic() - started)))
+            if 'LastEvaluatedKey' not in response:
+                return moved
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _batch_write(self, request_items):
+        """BatchWriteItem with retries of whatever DynamoDB leaves unprocessed."""
+        delay = 0.05
+        while request_items:
+            request_items = self.client.batch_write_item(RequestItems=request_items).get('UnprocessedItems', {})
+            if request_items:
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
@@ -0,0 +1,64 @@
+from dataclasses import dataclass, fields
+
+## The records passed between DynamoDBHelper, the roster and the handlers. They are frozen, so
+## a cached person or session can be shared between handlers without copying, and slotted, so
+## the thousands of them in a roster or a history read carry no per-instance __dict__.
+
+
+@dataclass(frozen=True, slots=True)
+class Person:
+    name: str
+    role: str
+    cell_group: str
+    telegram_id: str = 'None'
+
+    @classmethod
+    def from_item(cls, item):
+        """A Person from a dict of attributes (a deserialized item or stream image); extra keys are ignored."""
+        return cls(**{field.name: str(item[field.name]) for field in fields(cls) if field.name in item})
+
+    @property
+    def has_telegram(self):
+        return self.telegram_id not in ('', 'None')
+
+
+@dataclass(frozen=True, slots=True)
+class AttendanceRecord:
+    cell_group: str
+    event_type: str
+    date_attended: str   # 'YYYY-MM-DD'
+    name: str
+    attendance_type: str
+
+    @classmethod
+    def from_item(cls, item):
+        """An AttendanceRecord from a dict of attributes; date_attended is expected to be normalized already."""
+        return cls(**{field.name: item[field.name] for field in fields(cls)})
+
+
+@dataclass(frozen=True, slots=True)
+class AttendanceSession:
+    """Everyone recorded for one (cell group, event type, date), by attendance type."""
+    cell_group: str
+    event_type: str
+    date_attended: str   # 'YYYY-MM-DD'
+    types: tuple = ()    # ((attendance_type, frozenset of names), ...), sorted by attendance type
+
+    @classmethod
+    def from_types(cls, cell_group, event_type, date_attended, by_type):
+        """A session from {attendance_type: names}; empty types are dropped."""
+        return cls(cell_group, event_type, date_attended, tuple(sorted((attendance_type, frozenset(names)) for attendance_type, names in by_type.items() if names)))
+
+    def names(self, attendance_type):
+        for recorded_type, names in self.types:
+            if recorded_type == attendance_type:
+                return names
+        return frozenset()
+
+    def by_name(self):
+        """{name: attendance_type} of everyone recorded."""
+        return {name: attendance_type for attendance_type, names in self.types for name in names}
+
+    def records(self):
+        """The session as one AttendanceRecord per recorded name."""
+        return [AttendanceRecord(self.cell_group, self.event_type, self.date_attended, name, attendance_type) for attendance_type, names in self.types for name in sorted(names)]
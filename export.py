@@ -0,0 +1,91 @@
+import calendar
+import csv
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from dynamodbhelperv4 import month_bucket
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_COLUMNS = ('date_attended', 'event_type', 'name', 'attendance_type')
+
+
+def write_csv(records, path):
+    """Write AttendanceRecords to a CSV file one at a time; only the current one is held in memory."""
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS)
+        for record in records:
+            writer.writerow([getattr(record, column) for column in EXPORT_COLUMNS])
+            count += 1
+    return count
+
+def write_xlsx(records, path):
+    """Write AttendanceRecords to an XLSX file with openpyxl's write-only mode, which streams rows to disk."""
+    try:
+        import openpyxl
+    except ImportError:
+        raise ValueError("XLSX exports need openpyxl installed, please ask for a CSV instead")
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('attendance')
+    sheet.append(EXPORT_COLUMNS)
+    count = 0
+    for record in records:
+        sheet.append([getattr(record, column) for column in EXPORT_COLUMNS])
+        count += 1
+    workbook.save(path)
+    return count
+
+WRITERS = {'csv': write_csv, 'xlsx': write_xlsx}
+
+
+class ReportExporter:
+    """Monthly attendance sheets of one cell, written to files under a directory and reused.
+
+    Rows are streamed from DynamoDBHelper.iter_cell_history() straight into the writer, so
+    memory stays flat however long the month is. A finished file is served again for
+    repeated requests until it is older than cache_seconds or invalidate() is called for
+    its cell and month (conversation.written() does that once a write reaches DynamoDB)."""
+
+    def __init__(self, db, directory=None, cache_seconds=None, event_types=()):
+        self.db = db
+        self.directory = directory or os.getenv('EXPORT_DIR', '/tmp/exports')
+        self.cache_seconds = float(cache_seconds or os.getenv('EXPORT_CACHE_SECONDS', 600))
+        self.event_types = event_types
+        self.lock = threading.Lock()
+        self.files = {}   # (cell_group, 'YYYY-MM', fmt) -> (path, row count, created)
+
+    def export(self, cell_group, month, fmt='csv'):
+        """(path, row count) of the sheet of one cell for one 'YYYY-MM' month, from the cache when fresh."""
+        if fmt not in WRITERS:
+            raise ValueError(f"unknown export format '{fmt}', use one of {', '.join(EXPORT_FORMATS)}")
+        start = datetime.strptime(month, '%Y-%m')
+        end = start.replace(day=calendar.monthrange(start.year, start.month)[1])
+
+        key = (cell_group, month, fmt)
+        with self.lock:
+            entry = self.files.get(key)
+        if entry is not None and time.time() - entry[2] < self.cache_seconds and os.path.exists(entry[0]):
+            return entry[0], entry[1]
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"attendance-{''.join(c if c.isalnum() else '_' for c in cell_group)}-{month}.{fmt}")
+        ## write to a side file and rename, so a concurrent request never sends half a sheet
+        partial = f'{path}.{threading.get_ident()}.tmp'
+        count = WRITERS[fmt](self.db.iter_cell_history(cell_group, start, end, event_types=self.event_types), partial)
+        os.replace(partial, path)
+        with self.lock:
+            self.files[key] = (path, count, time.time())
+        return path, count
+
+    def invalidate(self, cell_group, date_attended):
+        """Forget the cached sheets of the cell and month of a new write."""
+        month = month_bucket(date_attended)
+        with self.lock:
+            for key in [key for key in self.files if key[:2] == (cell_group, month)]:
+                del self.files[key]
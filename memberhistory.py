@@ -0,0 +1,77 @@
+import html
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from dynamodbhelperv4 import encode_date
+from models import AttendanceRecord
+
+
+class MemberHistory:
+    """A member's own attendance summary for /myattendance, cached until they are written to.
+
+    Rows come from the member-partitioned name-date index over the last `days` days, so a
+    summary costs the member's rows and not the table. In the compact format sessions are
+    stored per cell, so the compact items of the member's cell in that range are read as well
+    (one item per session, not the cell's rows). A rendered summary is reused until
+    invalidate() is called for the member, by this process's journalled writes and by the
+    change feed for everyone else's, or until it is older than ttl."""
+
+    def __init__(self, db, days=None, ttl=None, event_types=()):
+        self.db = db
+        self.days = int(days or os.getenv('MYATTENDANCE_DAYS', 180))
+        self.ttl = float(ttl or os.getenv('MYATTENDANCE_CACHE_SECONDS', 3600))
+        self.event_types = event_types
+        self.lock = threading.Lock()
+        self.summaries = {}   # name -> (summary, created)
+        self.writes = Counter()   # name -> invalidations so far, so a summary built across a write is not kept
+
+    def records(self, person, start, end):
+        """Every AttendanceRecord of the person between two dates, in date order."""
+        records = {(record.date_attended, record.event_type): record for record in self.db.get_member_history(person.name, start, end)}
+        if self.db.compact:
+            ## a session stored both ways comes from its compact item, as in iter_cell_history()
+            for session in self.db.iter_compact_sessions(person.cell_group, start, end, self.event_types):
+                key = (session.date_attended, session.event_type)
+                attendance_type = session.by_name().get(person.name)
+                if attendance_type is None:
+                    records.pop(key, None)
+                else:
+                    records[key] = AttendanceRecord(session.cell_group, session.event_type, session.date_attended, person.name, attendance_type)
+        return [records[key] for key in sorted(records)]
+
+    def summary(self, person):
+        """The rendered summary of a person, from the cache when fresh."""
+        with self.lock:
+            entry = self.summaries.get(person.name)
+            writes = self.writes[person.name]
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            return entry[0]
+
+        end = datetime.now()
+        start = end - timedelta(days=self.days)
+        records = self.records(person, start, end)
+        counts = Counter((record.event_type, record.attendance_type) for record in records)
+        lines = [f"<b>Your attendance since {encode_date(start)}</b>"]
+        for event_type in sorted({event_type for event_type, _ in counts}):
+            lines.append(f"{html.escape(event_type)}: present {counts[(event_type, 'Present')]}, valid absences {counts[(event_type, 'Absent Valid')]}")
+        present = [record for record in records if record.attendance_type == 'Present']
+        if present:
+            lines.append("\n<b>Last attended</b>")
+            lines += [f"{record.date_attended} {html.escape(record.event_type)}" for record in present[-5:][::-1]]
+        else:
+            lines.append("No attendance recorded yet.")
+        summary = "\n".join(lines)
+
+        with self.lock:
+            if self.writes[person.name] == writes:
+                self.summaries[person.name] = (summary, time.time())
+        return summary
+
+    def invalidate(self, names):
+        with self.lock:
+            for name in names:
+                self.summaries.pop(name, None)
+                self.writes[name] += 1
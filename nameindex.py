@@ -0,0 +1,65 @@
+from collections import Counter, defaultdict
+
+
+def normalize(name: str) -> str:
+    """Case-fold a name and collapse its whitespace: ' nehemiah  TAN ' -> 'nehemiah tan'."""
+    return ' '.join(name.casefold().split())
+
+def trigrams(normalized: str) -> set:
+    """The padded character trigrams of a normalized name."""
+    padded = f'  {normalized} '
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """Trigram index over member names, for exact-after-normalization matches and fuzzy suggestions.
+
+    Lookups only touch the postings of the query's own trigrams, so they stay well
+    under a millisecond for rosters of thousands of names."""
+
+    def __init__(self, names=()):
+        self.canonical = {}               # normalized name -> name as stored
+        self.grams = {}                   # normalized name -> its trigrams
+        self.postings = defaultdict(set)  # trigram -> normalized names containing it
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.canonical)
+
+    def add(self, name):
+        key = normalize(name)
+        if key in self.canonical:
+            return
+        self.canonical[key] = name
+        self.grams[key] = trigrams(key)
+        for gram in self.grams[key]:
+            self.postings[gram].add(key)
+
+    def remove(self, name):
+        key = normalize(name)
+        if self.canonical.pop(key, None) is None:
+            return
+        for gram in self.grams.pop(key):
+            self.postings[gram].discard(key)
+            if not self.postings[gram]:
+                del self.postings[gram]
+
+    def exact(self, name):
+        """The stored spelling of a name which matches after normalization, or None."""
+        return self.canonical.get(normalize(name))
+
+    def suggest(self, name, limit=3, threshold=0.4):
+        """Up to `limit` stored names ranked by trigram (Jaccard) similarity to `name`."""
+        query = trigrams(normalize(name))
+        overlaps = Counter()
+        for gram in query:
+            overlaps.update(self.postings.get(gram, ()))
+
+        scored = []
+        for key, overlap in overlaps.items():
+            similarity = overlap / (len(query) + len(self.grams[key]) - overlap)
+            if similarity >= threshold:
+                scored.append((similarity, self.canonical[key]))
+        scored.sort(key=lambda pair: (-pair[0], pair[1]))
+        return [candidate for _, candidate in scored[:limit]]
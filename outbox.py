@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from dynamodbhelperv4 import is_transient
+
+logger = logging.getLogger(__name__)
+
+
+def transient(error):
+    """Whether a write may succeed unchanged later: see is_transient(), plus a busy (locked) local SQLite store."""
+    return is_transient(error) or (isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error)))
+
+
+class Outbox:
+    """Durable local journal of attendance writes, drained to DynamoDB in the background.
+
+    A whole commit is appended in one SQLite transaction before the user is answered,
+    so a throttled or unreachable DynamoDB never loses a session. The flusher drains
+    the journal in order and in batches, and anything left over is replayed on restart.
+
+    Entries are (op, payload) pairs understood by DynamoDBHelper.apply_ops():
+    'add_attendance', 'del_attendance', 'put_session' and 'add_new_member'. on_written(ops), if
+    given, is called with every batch once DynamoDB has it, e.g. to drop caches it outdates.
+
+    Transient failures (throttling, outages, an open circuit breaker) are retried with backoff
+    for as long as they last and cost no attempts. Only an entry DynamoDB keeps refusing uses up
+    its max_attempts; it is then marked dead, logged, and kept for dead() and revive()."""
+
+    def __init__(self, db, path=None, batch_size=25, max_attempts=10, on_written=None):
+        self.db = db
+        self.on_written = on_written
+        self.path = path or os.getenv('OUTBOX_PATH', '/tmp/attendance-outbox.sqlite')
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stopping = False
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, payload TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0, dead INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL)"
+        )
+
+    ## writing
+    def append(self, ops):
+        """Journal a list of (op, payload) pairs atomically and wake the flusher."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT INTO outbox (op, payload, created) VALUES (?, ?, ?)",
+                [(op, json.dumps(payload, default=str), now) for op, payload in ops],
+            )
+            self.conn.execute("COMMIT")
+        self.wakeup.set()
+        return len(ops)
+
+    def pending(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE dead = 0").fetchone()[0]
+
+    def dead(self, limit=20):
+        """(number of dead entries, [(id, op, payload, attempts)] of the oldest `limit`)."""
+        with self.lock:
+            count = self.conn.execute("SELECT COUNT(*) FROM outbox WHERE dead = 1").fetchone()[0]
+            entries = self.conn.execute("SELECT id, op, payload, attempts FROM outbox WHERE dead = 1 ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return count, [(entry_id, op, json.loads(payload), attempts) for entry_id, op, payload, attempts in entries]
+
+    def revive(self):
+        """Put every dead entry back in the journal with fresh attempts, e.g. after fixing what it tripped over."""
+        with self.lock:
+            revived = self.conn.execute("UPDATE outbox SET dead = 0, attempts = 0 WHERE dead = 1").rowcount
+        self.wakeup.set()
+        return revived
+
+    ## draining
+    def drain_once(self):
+        """Send the oldest batch to DynamoDB. Returns how many entries were written; raises on failure.
+
+        When the batch is refused for a reason other than a transient one, its entries are sent
+        one at a time, in order, so only the entry at fault is charged an attempt."""
+        with self.lock:
+            entries = self.conn.execute(
+                "SELECT id, op, payload, attempts FROM outbox WHERE dead = 0 ORDER BY id LIMIT ?", (self.batch_size,)
+            ).fetchall()
+        if not entries:
+            return 0
+
+        try:
+            self._apply(entries)
+            return len(entries)
+        except Exception as e:
+            if transient(e):
+                raise
+            if len(entries) == 1:
+                self._failed(entries[0], e)
+                raise
+        written = 0
+        for entry in entries:
+            try:
+                self._apply([entry])
+            except Exception as e:
+                if not transient(e):
+                    self._failed(entry, e)
+                raise
+            written += 1
+        return written
+
+    def _apply(self, entries):
+        """Write entries and drop them from the journal."""
+        ops = [(op, json.loads(payload)) for _, op, payload, _ in entries]
+        self.db.apply_ops(ops)
+        with self.lock:
+            self.conn.executemany("DELETE FROM outbox WHERE id = ?", [(entry[0],) for entry in entries])
+        if self.on_written is not None:
+            try:
+                self.on_written(ops)
+            except Exception:
+                logger.exception("outbox on_written callback failed")
+
+    def _failed(self, entry, error):
+        """Charge an entry an attempt for a non-transient failure, and mark it dead after max_attempts."""
+        entry_id, op, payload, attempts = entry
+        with self.lock:
+            self.conn.execute("UPDATE outbox SET attempts = attempts + 1, dead = (attempts + 1 >= ?) WHERE id = ?", (self.max_attempts, entry_id))
+        if attempts + 1 >= self.max_attempts:
+            logger.error("outbox entry %s is dead after %s attempts: %s %s (%s)", entry_id, attempts + 1, op, payload, error)
+
+    def drain(self):
+        """Drain until the journal is empty or DynamoDB fails. Returns how many entries were written."""
+        written = 0
+        try:
+            while True:
+                batch = self.drain_once()
+                if not batch:
+                    return written
+                written += batch
+        except Exception as e:
+            if transient(e):
+                logger.info("DynamoDB unavailable (%s), %s outbox entries queued", type(e).__name__, self.pending())
+            else:
+                logger.exception("outbox drain failed with %s entries pending", self.pending())
+            return written
+
+    ## background flusher
+    def start(self, idle_interval=5.0, max_backoff=60.0):
+        """Replay whatever a previous run left behind, then keep draining in a daemon thread."""
+        def run():
+            backoff = idle_interval
+            while not self.stopping:
+                self.wakeup.wait(backoff)
+                self.wakeup.clear()
+                self.drain()
+                # back off while entries stay stuck, reset once the journal is empty
+                backoff = min(backoff * 2, max_backoff) if self.pending() else idle_interval
+
+        self.stopping = False
+        self.wakeup.set()
+        self.thread = threading.Thread(target=run, name='outbox-flusher', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10.0):
+        self.stopping = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.drain()
@@ -0,0 +1,129 @@
+import collections
+import glob
+import logging
+import os
+import sys
+import threading
+import time
+
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+## frames which only mean a thread is waiting for work; stacks ending in them are not samples
+IDLE_FRAMES = {('selectors.py', 'select'), ('thread.py', '_worker'), ('threading.py', 'wait'), ('queue.py', 'get')}
+
+
+def collapse(frame):
+    """A frame's stack as 'file:function;file:function;...', outermost first, or None when idle."""
+    stack = []
+    while frame is not None:
+        stack.append((os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+        frame = frame.f_back
+    if not stack or stack[0] in IDLE_FRAMES:
+        return None
+    return ';'.join(f'{filename}:{function}' for filename, function in reversed(stack))
+
+
+class UpdateProfiler:
+    """Opt-in sampling profiler for slow updates.
+
+    While an update is being processed a sampler thread takes the stacks of the event loop
+    and of the worker threads (where boto3 runs) every interval_ms. When the update took
+    longer than slow_ms, or is the n-th of every `every` updates, its samples are saved to
+    `directory` as collapsed stacks ('stack count' lines, the input of flamegraph.pl and
+    speedscope). Nothing is installed unless PROFILE_DIR is set."""
+
+    def __init__(self, directory=None, slow_ms=None, every=None, interval_ms=None):
+        self.directory = directory or os.getenv('PROFILE_DIR')
+        self.slow_ms = float(slow_ms or os.getenv('PROFILE_SLOW_MS', 1000))
+        self.every = int(every or os.getenv('PROFILE_EVERY', 0))
+        self.interval = float(interval_ms or os.getenv('PROFILE_INTERVAL_MS', 5)) / 1000
+        self.lock = threading.Lock()
+        self.active = {}   # id of an update in flight -> Counter of collapsed stacks
+        self.busy = threading.Event()
+        self.thread = None
+        self.count = 0
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    ## sampling
+    def _sample(self):
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while True:
+            self.busy.wait()
+            stacks = [
+                f'{names.get(ident, ident)};{stack}'
+                for ident, frame in sys._current_frames().items()
+                if ident != me and (stack := collapse(frame)) is not None
+            ]
+            with self.lock:
+                for samples in self.active.values():
+                    samples.update(stacks)
+            time.sleep(self.interval)
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+    async def run(self, coroutine, update):
+        """Await one update's processing under the sampler and keep the profile if it qualifies."""
+        if self.thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.thread = threading.Thread(target=self._sample, name='update-profiler', daemon=True)
+            self.thread.start()
+
+        key, samples = object(), collections.Counter()
+        with self.lock:
+            self.active[key] = samples
+            self.count += 1
+            sampled = self.every and self.count % self.every == 0
+            self.busy.set()
+        start = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self.lock:
+                del self.active[key]
+                if not self.active:
+                    self.busy.clear()
+            if samples and (elapsed_ms >= self.slow_ms or sampled):
+                self.save(samples, elapsed_ms, getattr(update, 'update_id', 'update'))
+
+    def save(self, samples, elapsed_ms, update_id):
+        path = os.path.join(self.directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{update_id}-{elapsed_ms:.0f}ms.collapsed')
+        try:
+            with open(path, 'w') as f:
+                f.writelines(f'{stack} {count}\n' for stack, count in samples.items())
+        except OSError:
+            logger.exception("could not write the profile to %s", path)
+        else:
+            logger.info("update %s took %.0f ms, profile saved to %s", update_id, elapsed_ms, path)
+
+    ## reporting
+    def summarize(self, profiles=20, limit=10):
+        """(number of profiles read, [(frame, self samples, total samples, share of all samples)]) of the latest profiles."""
+        paths = sorted(glob.glob(os.path.join(self.directory, '*.collapsed')))[-profiles:]
+        own, total, samples = collections.Counter(), collections.Counter(), 0
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    frames = stack.split(';')[1:]  # the first entry is the thread name
+                    count = int(count)
+                    samples += count
+                    own[frames[-1]] += count
+                    for frame in set(frames):
+                        total[frame] += count
+        hot = [(frame, own[frame], total[frame], own[frame] / samples) for frame, _ in own.most_common(limit)]
+        return len(paths), hot
+
+
+def make_application_class(profiler):
+    """An Application whose process_update runs under the profiler, for ApplicationBuilder.application_class()."""
+    class ProfilingApplication(Application):
+        async def process_update(self, update):
+            return await profiler.run(super().process_update(update), update)
+    return ProfilingApplication
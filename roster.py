@@ -0,0 +1,104 @@
+import threading
+
+from models import Person
+from nameindex import NameIndex
+
+
+class RosterCache:
+    """In-process view of the person table.
+
+    It is loaded once with a single scan and then kept fresh by applying change
+    records (see changefeed.py), so no handler needs a rescan to see new members."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.people = {}                        # name -> Person
+        self.members = {}                       # cell_group -> set of names
+        self.index = NameIndex()                # fuzzy lookup over every name in people
+        self.loaded = False
+        self.version = None                     # roster version counter the cache was filled at
+
+    ## loading
+    def load(self, db):
+        """Fill the cache from one scan of the person table."""
+        self.load_people(db.get_people())
+
+    def load_people(self, people, version=None):
+        """Fill the cache from a list of Persons, e.g. a scan or a snapshot (see snapshot.py)."""
+        with self.lock:
+            self.people, self.members, self.index = {}, {}, NameIndex()
+            for person in people:
+                self._put_person(person)
+            self.version = version
+            self.loaded = True
+
+    ## reads
+    def cell_groups(self):
+        with self.lock:
+            return sorted(cell for cell, names in self.members.items() if names)
+
+    def has_cell(self, cell_group):
+        with self.lock:
+            return bool(self.members.get(cell_group))
+
+    def cell_members(self, cell_group):
+        with self.lock:
+            return sorted(self.members.get(cell_group, ()))
+
+    def unselected(self, cell_group, selected):
+        """The set of a cell's members not in `selected`, in one set difference."""
+        with self.lock:
+            return self.members.get(cell_group, set()) - selected
+
+    def is_member(self, name):
+        with self.lock:
+            return name in self.people
+
+    def people_where(self, **attributes):
+        """Every person whose attributes equal the given ones, e.g. people_where(role='Leader')."""
+        with self.lock:
+            return [person for person in self.people.values() if all(getattr(person, key) == value for key, value in attributes.items())]
+
+    def telegram_ids(self, names):
+        """{name: telegram_id} of the given names, for those who registered a Telegram ID."""
+        with self.lock:
+            people = [self.people.get(name) for name in names]
+        return {person.name: person.telegram_id for person in people if person is not None and person.has_telegram}
+
+    def match_name(self, name):
+        """The stored spelling of a name after normalization, or None."""
+        with self.lock:
+            return self.index.exact(name)
+
+    def suggest_names(self, name, limit=3):
+        with self.lock:
+            return self.index.suggest(name, limit)
+
+    ## incremental updates
+    def add_member(self, person):
+        with self.lock:
+            self._put_person(person)
+
+    def remove_member(self, person):
+        with self.lock:
+            self._drop_person(person)
+
+    def apply(self, change):
+        """Apply one parsed change record: (table, event_name, new_image, old_image). Only person records change the roster."""
+        table, event_name, new_image, old_image = change
+        if table == 'person':
+            if old_image:
+                self.remove_member(Person.from_item(old_image))
+            if new_image:
+                self.add_member(Person.from_item(new_image))
+
+    ## internals, called with the lock held
+    def _put_person(self, person):
+        self.people[person.name] = person
+        self.members.setdefault(person.cell_group, set()).add(person.name)
+        self.index.add(person.name)
+
+    def _drop_person(self, person):
+        self.people.pop(person.name, None)
+        self.members.get(person.cell_group, set()).discard(person.name)
+        self.index.remove(person.name)
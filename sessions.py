@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class DraftStore:
+    """Unfinished sessions put aside by SessionTracker, at most one per user, in a local SQLite file.
+
+    Drafts are JSON, so they outlive restarts and Lambda containers sharing /tmp, and are
+    dropped after max_age_days (DRAFT_MAX_AGE_DAYS, 14 by default)."""
+
+    def __init__(self, path=None, max_age_days=None):
+        self.path = path or os.getenv('DRAFTS_PATH', '/tmp/attendance-drafts.sqlite')
+        self.max_age = float(max_age_days or os.getenv('DRAFT_MAX_AGE_DAYS', 14)) * 24 * 3600
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS drafts (user_id TEXT PRIMARY KEY, draft TEXT NOT NULL, saved REAL NOT NULL)")
+
+    def save(self, user_id, draft):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO drafts (user_id, draft, saved) VALUES (?, ?, ?)", (str(user_id), json.dumps(draft, default=str), time.time()))
+
+    def pop(self, user_id):
+        """Take a user's draft out of the store, or None if there is none younger than max_age."""
+        with self.lock:
+            row = self.conn.execute("SELECT draft, saved FROM drafts WHERE user_id = ?", (str(user_id),)).fetchone()
+            self.conn.execute("DELETE FROM drafts WHERE user_id = ?", (str(user_id),))
+        if row is None or time.time() - row[1] > self.max_age:
+            return None
+        return json.loads(row[0])
+
+    def prune(self):
+        with self.lock:
+            return self.conn.execute("DELETE FROM drafts WHERE saved < ?", (time.time() - self.max_age,)).rowcount
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM drafts").fetchone()[0]
+
+
+class SessionTracker:
+    """Bounds the conversation state a long-running bot keeps in memory.
+
+    Every conversation update touches its user's session. A session is evicted when it
+    had no update for `timeout` seconds (SESSION_TIMEOUT_SECONDS, 30 minutes by default)
+    or when more than max_sessions (MAX_TRACKED_SESSIONS, 200) are open and it is the
+    least recently used. on_evict(user_id, user_data) puts the session aside (e.g. into a
+    DraftStore) and clears it, and returns whether anything was kept."""
+
+    def __init__(self, on_evict, timeout=None, max_sessions=None):
+        self.on_evict = on_evict
+        self.timeout = float(timeout or os.getenv('SESSION_TIMEOUT_SECONDS', 1800))
+        self.max_sessions = int(max_sessions or os.getenv('MAX_TRACKED_SESSIONS', 200))
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()   # user_id -> user_data of an open session, least recently used first
+        self.evicted = Counter()        # reason -> sessions evicted so far
+
+    def touch(self, user_id, user_data):
+        """Mark a session as just used. Returns the ids of the users evicted to stay under max_sessions."""
+        user_data['_touched'] = time.time()
+        with self.lock:
+            self.sessions[user_id] = user_data
+            self.sessions.move_to_end(user_id)
+            over = [self.sessions.popitem(last=False) for _ in range(len(self.sessions) - self.max_sessions)]
+        for evicted_id, evicted_data in over:
+            self.evict(evicted_id, evicted_data, 'lru')
+        return [evicted_id for evicted_id, _ in over]
+
+    def finish(self, user_id):
+        """Stop tracking a session which ended normally."""
+        with self.lock:
+            self.sessions.pop(user_id, None)
+
+    def evict(self, user_id, user_data, reason):
+        self.finish(user_id)
+        kept = self.on_evict(user_id, user_data)
+        self.evicted[reason] += 1
+        logger.info("evicted the %s session of user %s, draft kept: %s", reason, user_id, kept)
+        return kept
+
+    def sweep(self, user_datas):
+        """Evict every idle session of {user_id: user_data}, including sessions restored from
+        persistence which this process never touched. Returns the ids of the evicted users."""
+        cutoff = time.time() - self.timeout
+        evicted = []
+        for user_id, user_data in list(user_datas.items()):
+            if user_data.get('_touched', 0) < cutoff and set(user_data) - {'_auth'}:
+                self.evict(user_id, user_data, 'idle')
+                evicted.append(user_id)
+        return evicted
+
+    def metrics(self, user_datas):
+        """Memory accounting of {user_id: user_data}, measured as the pickled size persistence writes."""
+        sizes = [len(pickle.dumps(user_data, pickle.HIGHEST_PROTOCOL)) for user_data in user_datas.values()]
+        with self.lock:
+            tracked = len(self.sessions)
+        return {
+            'users': len(sizes),
+            'open_sessions': sum(1 for user_data in user_datas.values() if set(user_data) - {'_auth'}),
+            'tracked_sessions': tracked,
+            'state_bytes': sum(sizes),
+            'largest_state_bytes': max(sizes, default=0),
+            'evicted_idle': self.evicted['idle'],
+            'evicted_lru': self.evicted['lru'],
+        }
@@ -0,0 +1,121 @@
+import logging
+import marshal
+import os
+import time
+import zlib
+
+from models import Person
+
+logger = logging.getLogger(__name__)
+
+## bump when the layout of the snapshot file changes
+SNAPSHOT_FORMAT = 1
+
+
+class RosterSnapshot:
+    """The roster serialized into a small binary file, so a warm Lambda region skips the person scan.
+
+    The file holds the roster version it was taken at (the counter kept by
+    DynamoDBHelper.get_roster_version_counter) and is only trusted while that counter
+    has not moved; otherwise the roster is rescanned and the file rewritten. An unknown
+    version (None, no meta table) never matches, so the roster is always rescanned."""
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv('ROSTER_SNAPSHOT_PATH', '/tmp/roster.snapshot')
+
+    def save(self, version, people):
+        rows = [(person.name, person.role, person.cell_group, person.telegram_id) for person in people]
+        data = zlib.compress(marshal.dumps((SNAPSHOT_FORMAT, version, rows)))
+        ## write to a side file and rename, so a reader never sees half a snapshot
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(self.path + '.tmp', self.path)
+
+    def load(self):
+        """(version, [Person]) from the file, or None when it is missing, unreadable or of another format."""
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot_format, version, rows = marshal.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, EOFError, TypeError, zlib.error):
+            return None
+        if snapshot_format != SNAPSHOT_FORMAT:
+            return None
+        return version, [Person(*row) for row in rows]
+
+
+class RosterLoader:
+    """Keeps a RosterCache in step with the person table at the cost of one GetItem per check.
+
+    When the version moved, the person table is only rescanned if nothing else explains it:
+    versions produced by this process's own writes (db.own_roster_versions) are already in the
+    cache, and a live change feed delivers other writers' changes without a scan."""
+
+    def __init__(self, cache, db, snapshot=None, revalidate_seconds=None, feed=None):
+        self.cache = cache
+        self.db = db
+        self.feed = feed
+        self.snapshot = snapshot or RosterSnapshot()
+        self.revalidate_seconds = float(revalidate_seconds or os.getenv('ROSTER_REVALIDATE_SECONDS', 60))
+        self.checked = 0.0
+
+    def load(self):
+        """Fill the cache from the snapshot when it is current, else from a scan which is then snapshotted.
+
+        When DynamoDB cannot be reached any snapshot is used, however old, so the bot still starts."""
+        snapshot = self.snapshot.load()
+        try:
+            version = self.db.get_roster_version_counter()
+        except Exception:
+            if snapshot is None:
+                raise
+            logger.warning("DynamoDB unavailable, roster loaded from the snapshot at version %s", snapshot[0], exc_info=True)
+            self.cache.load_people(snapshot[1], snapshot[0])
+            self.checked = time.monotonic()
+            return
+        if snapshot is not None and version is not None and snapshot[0] == version:
+            self.cache.load_people(snapshot[1], version)
+            logger.info("roster loaded from snapshot at version %s", version)
+        else:
+            self._rescan(version)
+        self.checked = time.monotonic()
+
+    def revalidate(self, force=False):
+        """Rescan only if the roster version moved since the cache was filled; checks are rate-limited."""
+        if not force and time.monotonic() - self.checked < self.revalidate_seconds:
+            return False
+        self.checked = time.monotonic()
+        ## while DynamoDB is unavailable the cached roster is served as it is
+        try:
+            version = self.db.get_roster_version_counter()
+            if version is not None and version == self.cache.version:
+                return False
+            if self._caught_up(version):
+                logger.info("roster moved to version %s without a rescan", version)
+                self.cache.version = version
+                return False
+            self._rescan(version)
+        except Exception:
+            logger.warning("could not revalidate the roster, keeping version %s", self.cache.version, exc_info=True)
+            return False
+        return True
+
+    def _caught_up(self, version):
+        """Whether the cache already holds (or the change feed is delivering) every change up to version."""
+        if version is None or self.cache.version is None or version < self.cache.version:
+            return False
+        own = getattr(self.db, 'own_roster_versions', set())
+        if all(v in own for v in range(self.cache.version + 1, version + 1)):
+            return True
+        if self.feed is not None and self.feed.live:
+            self.feed.poll()
+            return True
+        return False
+
+    def _rescan(self, version):
+        ## the version is read before the scan, so a change during the scan moves it past ours
+        people = self.db.get_people()
+        self.cache.load_people(people, version)
+        try:
+            self.snapshot.save(version, people)
+        except OSError:
+            logger.exception("could not write the roster snapshot to %s", self.snapshot.path)
@@ -0,0 +1,375 @@
+"""Local SQLite storage for the self-hosted poller, and a sync tool between it and DynamoDB.
+
+    STORAGE_BACKEND=sqlite SQLITE_PATH=attendance.sqlite python main.py
+
+    python sqlitestore.py to-sqlite --path attendance.sqlite     # copy DynamoDB into SQLite
+    python sqlitestore.py to-dynamodb --path attendance.sqlite   # copy SQLite into DynamoDB
+
+A sync copies every person and attendance row and overwrites rows with the same key; it
+does not delete rows which are only on the receiving side.
+"""
+import argparse
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Iterator, Optional, Protocol, runtime_checkable
+
+from dynamodbhelperv4 import ARCHIVE_TABLE, DATE_FORMAT, CircuitBreaker, DynamoDBHelper, deserializer, encode_date, get_client
+from models import AttendanceRecord, AttendanceSession, Person
+
+logger = logging.getLogger(__name__)
+
+################################### Storage interface ###################################
+@runtime_checkable
+class Storage(Protocol):
+    """What the bot needs from its storage; DynamoDBHelper and SQLiteHelper both provide it.
+
+    compact says whether sessions are written with put_session, breaker is a CircuitBreaker
+    (None when the storage cannot be unavailable), and own_roster_versions holds the roster
+    versions bumped by this process's own writes, see RosterLoader. Table maintenance
+    (streams, indexes, migrate_dates, archive_attendance) stays specific to DynamoDB."""
+
+    compact: bool
+    breaker: Optional[CircuitBreaker]
+    own_roster_versions: set
+
+    def setup(self): ...
+    ## people
+    def get_people(self) -> list: ...
+    def get_person_by_telegram_id(self, telegram_id) -> Optional[Person]: ...
+    def get_cell_groups(self) -> list: ...
+    def get_cell_members(self, cell_group) -> list: ...
+    def get_roster_version_counter(self) -> int: ...
+    def bump_roster_version_counter(self) -> int: ...
+    ## sessions
+    def get_session_attendance(self, cell_group, event_type, date_attended) -> AttendanceSession: ...
+    def get_previous_session(self, cell_group, event_type, date_attended, lookback_days=None) -> Optional[AttendanceSession]: ...
+    def get_sessions_attendance(self, cell_group, sessions) -> dict: ...
+    def put_session(self, cell_group, event_type, date_attended, by_type, merge=False): ...
+    ## writes
+    def add_attendance(self, cell_group, event_type, date_attended, name, attendance_type): ...
+    def add_new_member(self, name, role, cell_group, telegram_id, birth_date): ...
+    def apply_ops(self, ops): ...
+    ## range queries
+    def get_member_history(self, name, start, end) -> list: ...
+    def get_cell_history(self, cell_group, start, end, event_type=None) -> list: ...
+    def iter_cell_history(self, cell_group, start, end, event_type=None, event_types=()) -> Iterator[AttendanceRecord]: ...
+    def iter_compact_sessions(self, cell_group, start, end, event_types) -> Iterator[AttendanceSession]: ...
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS person (
+    name TEXT NOT NULL, role TEXT NOT NULL, cell_group TEXT NOT NULL,
+    telegram_id TEXT NOT NULL DEFAULT 'None', birth_date TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (name, role)
+);
+CREATE INDEX IF NOT EXISTS person_cell_group ON person (cell_group);
+CREATE INDEX IF NOT EXISTS person_telegram_id ON person (telegram_id);
+
+CREATE TABLE IF NOT EXISTS attendance (
+    date_attended TEXT NOT NULL, name TEXT NOT NULL, cell_group TEXT NOT NULL,
+    event_type TEXT NOT NULL, attendance_type TEXT NOT NULL,
+    PRIMARY KEY (date_attended, name)
+);
+CREATE INDEX IF NOT EXISTS attendance_cell_group ON attendance (cell_group);
+CREATE INDEX IF NOT EXISTS attendance_session ON attendance (cell_group, event_type, date_attended);
+CREATE INDEX IF NOT EXISTS attendance_name ON attendance (name, date_attended);
+
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, version INTEGER NOT NULL);
+"""
+
+## every statement is a constant with ? parameters, so sqlite3's per-connection statement
+## cache prepares each one once and reuses it
+SELECT_PEOPLE = "SELECT name, role, cell_group, telegram_id FROM person"
+SELECT_PERSON_BY_TELEGRAM_ID = "SELECT name, role, cell_group, telegram_id FROM person WHERE telegram_id = ? LIMIT 1"
+SELECT_CELL_GROUPS = "SELECT DISTINCT cell_group FROM person"
+SELECT_CELL_MEMBERS = "SELECT DISTINCT name FROM person WHERE cell_group = ?"
+SELECT_VERSION = "SELECT version FROM meta WHERE key = 'roster_version'"
+BUMP_VERSION = "INSERT INTO meta (key, version) VALUES ('roster_version', 1) ON CONFLICT (key) DO UPDATE SET version = version + 1"
+SELECT_SESSION = (
+    "SELECT name, attendance_type FROM attendance"
+    " WHERE cell_group = ? AND event_type = ? AND date_attended = ?"
+)
+SELECT_PREVIOUS_SESSION = (
+    "SELECT date_attended, name, attendance_type FROM attendance"
+    " WHERE cell_group = ? AND event_type = ? AND date_attended = ("
+    "  SELECT MAX(date_attended) FROM attendance"
+    "  WHERE cell_group = ? AND event_type = ? AND date_attended >= ? AND date_attended < ?)"
+)
+SELECT_SESSIONS = (
+    "SELECT date_attended, name, attendance_type FROM attendance"
+    " WHERE cell_group = ? AND event_type = ? AND date_attended BETWEEN ? AND ?"
+)
+SELECT_MEMBER_HISTORY = (
+    "SELECT cell_group, event_type, date_attended, name, attendance_type FROM attendance"
+    " WHERE name = ? AND date_attended BETWEEN ? AND ? ORDER BY date_attended"
+)
+SELECT_CELL_HISTORY = (
+    "SELECT cell_group, event_type, date_attended, name, attendance_type FROM attendance"
+    " WHERE cell_group = ? AND date_attended BETWEEN ? AND ? ORDER BY date_attended"
+)
+SELECT_CELL_EVENT_HISTORY = (
+    "SELECT cell_group, event_type, date_attended, name, attendance_type FROM attendance"
+    " WHERE cell_group = ? AND event_type = ? AND date_attended BETWEEN ? AND ? ORDER BY date_attended"
+)
+SELECT_ALL_PEOPLE = "SELECT name, role, cell_group, telegram_id, birth_date FROM person"
+SELECT_ALL_ATTENDANCE = "SELECT cell_group, event_type, date_attended, name, attendance_type FROM attendance ORDER BY cell_group, event_type, date_attended"
+PUT_ATTENDANCE = (
+    "INSERT OR REPLACE INTO attendance (cell_group, event_type, date_attended, name, attendance_type)"
+    " VALUES (:cell_group, :event_type, :date_attended, :name, :attendance_type)"
+)
+PUT_PERSON = (
+    "INSERT OR REPLACE INTO person (name, role, cell_group, telegram_id, birth_date)"
+    " VALUES (:name, :role, :cell_group, :telegram_id, :birth_date)"
+)
+DELETE_ATTENDANCE = (
+    "DELETE FROM attendance WHERE date_attended = :date_attended AND name = :name"
+    " AND attendance_type = :attendance_type AND cell_group = :cell_group AND event_type = :event_type"
+)
+DELETE_SESSION = "DELETE FROM attendance WHERE cell_group = ? AND event_type = ? AND date_attended = ?"
+
+
+class SQLiteHelper:
+    """The Storage interface over one local SQLite file.
+
+    Every thread gets its own connection; the file is in WAL mode, so lookups never wait
+    for a commit. Writes are serialized by a lock and apply_ops() writes a whole outbox
+    batch in one transaction. Sessions are stored as attendance rows (compact is False).
+    The schema is created on construction, so a fresh file is usable at once."""
+
+    compact = False
+    breaker = None
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv('SQLITE_PATH', 'attendance.sqlite')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.own_roster_versions = set()   # see DynamoDBHelper.own_roster_versions
+        self.setup()
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=64)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self.local.conn = conn
+        return conn
+
+    def _write(self, statements, query=None):
+        """Run [(sql, [params, ...])] in one transaction, each as an executemany. A `query` is run
+        last in the same transaction and its first row returned."""
+        conn = self._conn()
+        with self.lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    conn.executemany(sql, params)
+                row = conn.execute(query).fetchone() if query else None
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        return row
+
+    def setup(self):
+        with self.lock:
+            self._conn().executescript(SCHEMA)
+
+    ## people
+    def get_people(self):
+        return [Person(*row) for row in self._conn().execute(SELECT_PEOPLE)]
+
+    def get_person_by_telegram_id(self, telegram_id):
+        row = self._conn().execute(SELECT_PERSON_BY_TELEGRAM_ID, (str(telegram_id),)).fetchone()
+        return Person(*row) if row else None
+
+    def get_cell_groups(self):
+        return [cell_group for cell_group, in self._conn().execute(SELECT_CELL_GROUPS)]
+
+    def get_cell_members(self, cell_group):
+        return [name for name, in self._conn().execute(SELECT_CELL_MEMBERS, (cell_group,))]
+
+    def get_roster_version_counter(self):
+        row = self._conn().execute(SELECT_VERSION).fetchone()
+        return row[0] if row else 0
+
+    def bump_roster_version_counter(self):
+        return self._write([(BUMP_VERSION, [()])], SELECT_VERSION)[0]
+
+    ## sessions
+    def get_session_attendance(self, cell_group, event_type, date_attended) -> AttendanceSession:
+        session = {}
+        for name, attendance_type in self._conn().execute(SELECT_SESSION, (cell_group, event_type, encode_date(date_attended))):
+            session.setdefault(attendance_type, set()).add(name)
+        return AttendanceSession.from_types(cell_group, event_type, encode_date(date_attended), session)
+
+    def get_previous_session(self, cell_group, event_type, date_attended, lookback_days=None):
+        """The latest session before date_attended within lookback_days, in one indexed statement; see DynamoDBHelper."""
+        before = encode_date(date_attended)
+        start = encode_date(datetime.strptime(before, DATE_FORMAT) - timedelta(days=int(lookback_days or os.getenv('PREFILL_LOOKBACK_DAYS', 35))))
+        latest, session = None, {}
+        for latest, name, attendance_type in self._conn().execute(SELECT_PREVIOUS_SESSION, (cell_group, event_type, cell_group, event_type, start, before)):
+            session.setdefault(attendance_type, set()).add(name)
+        return AttendanceSession.from_types(cell_group, event_type, latest, session) if latest else None
+
+    def get_sessions_attendance(self, cell_group, sessions) -> dict:
+        """{(event_type, 'YYYY-MM-DD'): AttendanceSession} of several sessions, one range read per event type."""
+        wanted = {(event_type, encode_date(date_attended)) for event_type, date_attended in sessions}
+        found = {}
+        for event_type, dates in itertools.groupby(sorted(wanted), key=lambda session: session[0]):
+            dates = [date_attended for _, date_attended in dates]
+            for date_attended, name, attendance_type in self._conn().execute(SELECT_SESSIONS, (cell_group, event_type, dates[0], dates[-1])):
+                if (event_type, date_attended) in wanted:
+                    found.setdefault((event_type, date_attended), {}).setdefault(attendance_type, set()).add(name)
+        return {key: AttendanceSession.from_types(cell_group, *key, found.get(key, {})) for key in wanted}
+
+    def put_session(self, cell_group, event_type, date_attended, by_type, merge=False):
+        """Replace a session's rows with by_type; with merge, rows of names not in by_type are kept."""
+        date_attended = encode_date(date_attended)
+        rows = [
+            {'cell_group': cell_group, 'event_type': event_type, 'date_attended': date_attended, 'name': name, 'attendance_type': attendance_type}
+            for attendance_type, names in by_type.items() for name in names
+        ]
+        self._write(([] if merge else [(DELETE_SESSION, [(cell_group, event_type, date_attended)])]) + [(PUT_ATTENDANCE, rows)])
+
+    ## writes
+    def add_attendance(self, cell_group, event_type, date_attended, name, attendance_type):
+        self.apply_ops([('add_attendance', {'cell_group': cell_group, 'event_type': event_type, 'date_attended': date_attended, 'name': name, 'attendance_type': attendance_type})])
+
+    def add_new_member(self, name, role, cell_group, telegram_id, birth_date):
+        self.apply_ops([('add_new_member', {'name': name, 'role': role, 'cell_group': cell_group, 'telegram_id': telegram_id, 'birth_date': birth_date})])
+
+    def apply_ops(self, ops):
+        """Apply journalled writes (see DynamoDBHelper.apply_ops) in order, in one transaction.
+        Runs of the same operation go to SQLite as one executemany."""
+        statements, people_written = [], False
+        for op, run in itertools.groupby(ops, key=lambda entry: entry[0]):
+            payloads = [dict(payload) for _, payload in run]
+            if op in ('add_attendance', 'del_attendance'):
+                for payload in payloads:
+                    payload['date_attended'] = encode_date(payload['date_attended'])
+                statements.append((PUT_ATTENDANCE if op == 'add_attendance' else DELETE_ATTENDANCE, payloads))
+            elif op == 'add_new_member':
+                statements.append((PUT_PERSON, [{**payload, 'telegram_id': str(payload['telegram_id'])} for payload in payloads]))
+                people_written = True
+            elif op == 'put_session':
+                for payload in payloads:
+                    date_attended = encode_date(payload['date_attended'])
+                    if not payload.get('merge'):
+                        statements.append((DELETE_SESSION, [(payload['cell_group'], payload['event_type'], date_attended)]))
+                    statements.append((PUT_ATTENDANCE, [
+                        {'cell_group': payload['cell_group'], 'event_type': payload['event_type'], 'date_attended': date_attended, 'name': name, 'attendance_type': attendance_type}
+                        for attendance_type, names in payload['by_type'].items() for name in names
+                    ]))
+            else:
+                raise ValueError(f"unknown outbox operation: {op!r}")
+        if people_written:
+            statements.append((BUMP_VERSION, [()]))
+            self.own_roster_versions.add(self._write(statements, SELECT_VERSION)[0])
+        else:
+            self._write(statements)
+
+    ## range queries
+    def get_member_history(self, name, start, end):
+        return [AttendanceRecord(*row) for row in self._conn().execute(SELECT_MEMBER_HISTORY, (name, encode_date(start), encode_date(end)))]
+
+    def get_cell_history(self, cell_group, start, end, event_type=None):
+        return list(self.iter_cell_history(cell_group, start, end, event_type))
+
+    def iter_cell_history(self, cell_group, start, end, event_type=None, event_types=()):
+        """Stream the AttendanceRecords of one cell between two dates; event_types only matters to compact DynamoDB sessions."""
+        if event_type is None:
+            cursor = self._conn().execute(SELECT_CELL_HISTORY, (cell_group, encode_date(start), encode_date(end)))
+        else:
+            cursor = self._conn().execute(SELECT_CELL_EVENT_HISTORY, (cell_group, event_type, encode_date(start), encode_date(end)))
+        for row in cursor:
+            yield AttendanceRecord(*row)
+
+    def iter_compact_sessions(self, cell_group, start, end, event_types):
+        """Sessions are stored as rows only, so there are no compact sessions."""
+        return iter(())
+
+    ## sync
+    def export_ops(self):
+        """Every person and attendance row as apply_ops() entries, people first."""
+        conn = self._conn()
+        for name, role, cell_group, telegram_id, birth_date in conn.execute(SELECT_ALL_PEOPLE):
+            yield 'add_new_member', {'name': name, 'role': role, 'cell_group': cell_group, 'telegram_id': telegram_id, 'birth_date': birth_date}
+        for cell_group, event_type, date_attended, name, attendance_type in conn.execute(SELECT_ALL_ATTENDANCE):
+            yield 'add_attendance', {'cell_group': cell_group, 'event_type': event_type, 'date_attended': date_attended, 'name': name, 'attendance_type': attendance_type}
+
+
+def make_storage() -> Storage:
+    """The storage of the running bot: SQLiteHelper when STORAGE_BACKEND=sqlite, otherwise DynamoDBHelper."""
+    if os.getenv('STORAGE_BACKEND', 'dynamodb') == 'sqlite':
+        return SQLiteHelper()
+    return DynamoDBHelper()
+
+
+################################### Sync ###################################
+def dynamodb_ops(db):
+    """Every person and attendance row of DynamoDB as apply_ops() entries, people first.
+    Archived rows and compact sessions are read too and come out as plain rows."""
+    def scan(table):
+        try:
+            yield from db.client.get_paginator('scan').paginate(TableName=table).search('Items')
+        except db.client.exceptions.ResourceNotFoundException:
+            logger.info("no %s table, skipping it", table)
+
+    for item in scan('person'):
+        row = {key: deserializer.deserialize(value) for key, value in item.items()}
+        yield 'add_new_member', {'name': row['name'], 'role': row['role'], 'cell_group': row['cell_group'], 'telegram_id': str(row.get('telegram_id', 'None')), 'birth_date': row.get('birth_date', '')}
+    for table in [ARCHIVE_TABLE, 'attendance']:
+        for item in scan(table):
+            row = {key: deserializer.deserialize(value) for key, value in item.items()}
+            yield 'add_attendance', {key: row[key] for key in ('cell_group', 'event_type', 'name', 'attendance_type')} | {'date_attended': encode_date(row['date_attended'])}
+    for item in scan('attendance_session'):
+        for attendance_type, names in db.decode_session(item).items():
+            for name in names:
+                yield 'add_attendance', {'cell_group': item['cell_group']['S'], 'event_type': item['event_type']['S'], 'date_attended': item['date_attended']['S'], 'name': name, 'attendance_type': attendance_type}
+
+def as_sessions(ops):
+    """Turn add_attendance entries sorted by session into one put_session entry per session, for compact DynamoDB."""
+    for op, run in itertools.groupby(ops, key=lambda entry: entry[0] == 'add_attendance' and (entry[1]['cell_group'], entry[1]['event_type'], entry[1]['date_attended'])):
+        if not op:
+            yield from run
+            continue
+        by_type = {}
+        for _, payload in run:
+            by_type.setdefault(payload['attendance_type'], []).append(payload['name'])
+        yield 'put_session', {'cell_group': op[0], 'event_type': op[1], 'date_attended': op[2], 'by_type': by_type, 'merge': True}
+
+def sync(ops, target, batch_size=500):
+    """Apply a stream of entries to the target storage in batches; returns how many were applied."""
+    applied = 0
+    while True:
+        batch = list(itertools.islice(ops, batch_size))
+        if not batch:
+            return applied
+        target.apply_ops(batch)
+        applied += len(batch)
+        logger.info("synced %s entries", applied)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('direction', choices=['to-sqlite', 'to-dynamodb'])
+    parser.add_argument('--path', default=os.getenv('SQLITE_PATH', 'attendance.sqlite'))
+    parser.add_argument('--endpoint-url', default=None)
+    args = parser.parse_args()
+
+    store, dynamodb = SQLiteHelper(args.path), DynamoDBHelper(get_client(endpoint_url=args.endpoint_url))
+    store.setup()
+    if args.direction == 'to-sqlite':
+        synced = sync(dynamodb_ops(dynamodb), store)
+    else:
+        dynamodb.setup()
+        ops = store.export_ops()
+        synced = sync(as_sessions(ops) if dynamodb.compact else ops, dynamodb)
+    print(f"synced {synced} entries {args.direction}")
@@ -0,0 +1,64 @@
+import csv
+import os
+import sys
+from datetime import datetime
+
+import boto3
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+moto = pytest.importorskip('moto')
+
+from dynamodbhelperv4 import DynamoDBHelper
+from export import ReportExporter
+
+EVENT_TYPES = ['Sunday Service', 'Cell Group']
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A compact-format DynamoDBHelper over moto, with three members in cell ONE."""
+    for key, value in [('AWS_DEFAULT_REGION', 'us-east-1'), ('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing')]:
+        monkeypatch.setenv(key, value)
+    monkeypatch.delenv('DYNAMODB_ENDPOINT_URL', raising=False)
+    with moto.mock_aws():
+        db = DynamoDBHelper(client=boto3.client('dynamodb'), compact=True)
+        db.client.create_table(
+            TableName='person',
+            KeySchema=[{'AttributeName': 'name', 'KeyType': 'HASH'}, {'AttributeName': 'role', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'name', 'AttributeType': 'S'}, {'AttributeName': 'role', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        db.setup()
+        for name in ['Ann', 'Ben', 'Cal']:
+            db.add_new_member(name, 'Member', 'ONE', 'None', '')
+        yield db
+
+
+def legacy_then_compact(db):
+    """2024-07-07 recorded as rows, then again as a compact session after Ben was removed;
+    2024-07-14 only as rows."""
+    for name in ['Ann', 'Ben']:
+        db.add_attendance('ONE', 'Sunday Service', datetime(2024, 7, 7), name, 'Present')
+    db.add_attendance('ONE', 'Sunday Service', datetime(2024, 7, 14), 'Cal', 'Present')
+    db.put_session('ONE', 'Sunday Service', datetime(2024, 7, 7), {'Present': ['Ann'], 'Absent Valid': ['Cal']})
+
+
+def test_mixed_sessions_come_from_the_compact_item_once(db):
+    legacy_then_compact(db)
+    records = sorted((record.date_attended, record.name, record.attendance_type)
+                     for record in db.iter_cell_history('ONE', datetime(2024, 7, 1), datetime(2024, 7, 31), event_types=EVENT_TYPES))
+    assert records == [
+        ('2024-07-07', 'Ann', 'Present'),
+        ('2024-07-07', 'Cal', 'Absent Valid'),
+        ('2024-07-14', 'Cal', 'Present'),
+    ]
+
+
+def test_export_of_mixed_sessions(db, tmp_path):
+    legacy_then_compact(db)
+    path, count = ReportExporter(db, directory=str(tmp_path), event_types=EVENT_TYPES).export('ONE', '2024-07')
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert count == len(rows) == 3
+    assert sorted((row['name'], row['date_attended']) for row in rows) == [('Ann', '2024-07-07'), ('Cal', '2024-07-07'), ('Cal', '2024-07-14')]
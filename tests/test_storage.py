@@ -0,0 +1,23 @@
+import inspect
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dynamodbhelperv4 import DynamoDBHelper
+from sqlitestore import SQLiteHelper, Storage
+
+METHODS = [name for name, member in vars(Storage).items() if inspect.isfunction(member) and not name.startswith('_')]
+
+
+@pytest.mark.parametrize('helper', [DynamoDBHelper, SQLiteHelper])
+@pytest.mark.parametrize('name', METHODS)
+def test_helpers_implement_storage(helper, name):
+    """Every Storage method exists on both helpers with the same parameters, so either can back the bot."""
+    assert list(inspect.signature(getattr(helper, name)).parameters) == list(inspect.signature(getattr(Storage, name)).parameters)
+
+
+def test_sqlite_helper_is_storage(tmp_path):
+    assert isinstance(SQLiteHelper(str(tmp_path / 'attendance.sqlite')), Storage)